@@ -0,0 +1,848 @@
+import asyncio
+import datetime
+import socket
+import ssl
+import urllib.parse
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.cache import http_cache
+from app.db.log_writer import traffic_log_writer
+from app.decoding import inspectable_encodings
+from app.filter import ContentBlockedError, ContentFilter, StreamingContentScanner
+from app.http_codec import (
+    LAST_CHUNK,
+    MAX_HEADER_SIZE,
+    AsyncMessageReader,
+    HTTPParser,
+    ProtocolError,
+    encode_chunk,
+    serialize_head,
+)
+from app.inspection import SKIP, inspection_policy
+from app.responses import admin_page, blocked_page, error_page
+from app.rule_index import host_matches
+from app.tls import ServerContextCache, upstream_tls
+from utils.logger import logger
+
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "proxy-connection",
+    "keep-alive",
+    "transfer-encoding",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "upgrade",
+}
+
+READ_SIZE = 65536
+
+Origin = Tuple[str, str, int]
+
+
+class _Upstream:
+    """A connection to an origin, with the parser reading its responses."""
+
+    def __init__(self, origin: Origin, reader, writer):
+        self.origin = origin
+        self.writer = writer
+        self.responses = AsyncMessageReader(
+            reader, HTTPParser(is_response=True), READ_SIZE
+        )
+        self.idle_since = 0.0
+
+    @property
+    def usable(self) -> bool:
+        return (
+            not self.writer.is_closing()
+            and not self.responses.eof
+            and self.responses.parser.idle
+        )
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncHTTPProxy:
+    """Asyncio proxy server handling every client connection on one event loop.
+
+    Bodies are streamed in bounded chunks in both directions, client
+    connections are kept alive between requests and idle origin
+    connections are reused, so memory stays flat however large a
+    transfer is.
+    """
+
+    # Seconds an idle keep-alive client connection waits for its next request
+    keep_alive_timeout = 15
+    # Seconds to connect to an origin, and to wait for its response head
+    upstream_timeout = 30
+    # Seconds a MITM tunnel waits on the origin for its response (long polls
+    # and event streams can be silent for minutes); None waits indefinitely
+    mitm_read_timeout = None
+    # Idle origin connections kept per origin, and how long each is kept
+    max_idle_per_host = 8
+    upstream_idle_timeout = 60
+    # Hold-back window: headers of a scanned text response wait until this many
+    # bytes pass the filter (or the body ends), so a match gets the block page
+    max_buffered_body = 1024 * 1024
+    # Compressed bodies stop being scanned once they decode past this size
+    max_decoded_body = 32 * 1024 * 1024
+    # Memory + disk response cache, shared with the threaded engine
+    cache = http_cache
+
+    def __init__(
+        self,
+        server_address,
+        content_filter: Optional[ContentFilter] = None,
+        mitm_mode: str = "always",
+        passthrough_hosts: Iterable[str] = (),
+        ca_cert_file: str = "proxy_ca.crt",
+        ca_key_file: str = "proxy_ca.key",
+    ):
+        self.server_address = server_address
+        self.filter = content_filter or ContentFilter()
+        # Same meaning as ProxyHTTPRequestHandler.mitm_mode / passthrough_hosts
+        self.mitm_mode = mitm_mode
+        self.passthrough_hosts = tuple(passthrough_hosts)
+        self.ca_cert_file = ca_cert_file
+        self.ca_key_file = ca_key_file
+        self.server_contexts = ServerContextCache(
+            ca_cert_file=ca_cert_file, ca_key_file=ca_key_file
+        )
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        # Names and addresses of this proxy; requests aimed at them would loop
+        self._own_hosts: Set[str] = set()
+        self._own_port: Optional[int] = None
+        self.open_connections = 0
+
+        self._idle: Dict[Origin, List[_Upstream]] = {}
+        self._last_sweep = 0.0
+        self.upstreams_created = 0
+        self.upstreams_reused = 0
+
+        # Upstream TLS for plain-HTTP forwarding does not verify, like the threaded engine
+        self._insecure_context = ssl.create_default_context()
+        self._insecure_context.check_hostname = False
+        self._insecure_context.verify_mode = ssl.CERT_NONE
+
+    # Same entry points as socketserver so create_http_proxy can drive both engines
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop and not self._loop.is_closed() and self._stop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    def server_close(self):
+        pass
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self._handle_client, host, port, limit=MAX_HEADER_SIZE
+        )
+        bound = [sock.getsockname() for sock in server.sockets]
+        self._own_port = bound[0][1]
+        self._own_hosts = {address[0] for address in bound} | {
+            host.lower(),
+            "localhost",
+            "127.0.0.1",
+            "::1",
+            socket.gethostname().lower(),
+        }
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            for idle in self._idle.values():
+                for upstream in idle:
+                    upstream.close()
+            self._idle.clear()
+
+    async def _handle_client(self, reader, writer):
+        client_ip = writer.get_extra_info("peername")[0]
+        self.open_connections += 1
+        client = AsyncMessageReader(reader, HTTPParser(is_response=False), READ_SIZE)
+        try:
+            served = 0
+            while True:
+                if served:
+                    try:
+                        request = await asyncio.wait_for(
+                            client.next_event(), self.keep_alive_timeout
+                        )
+                    except asyncio.TimeoutError:
+                        return
+                else:
+                    request = await client.next_event()
+                if request is None:
+                    return
+
+                if request.method == "CONNECT":
+                    await client.next_event()
+                    # Anything the client sent after the CONNECT head belongs to the tunnel
+                    early_data = client.parser.take_paused()
+                    await self._handle_connect(
+                        reader, writer, request.target, client_ip, early_data
+                    )
+                    return
+
+                if not await self._handle_http(client, writer, request, client_ip):
+                    return
+                served += 1
+                if client.parser.paused:
+                    # The upgrade was not passed on; parse what was held back
+                    client.push(client.parser.resume())
+        except (ConnectionError, ProtocolError, ssl.SSLError) as e:
+            logger.info(f"[ASYNC] connection from {client_ip} closed: {e}")
+        except Exception as e:
+            logger.error(f"[ASYNC ERROR] {e}")
+        finally:
+            self.open_connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def _send_simple(self, writer, code, reason, content_type, body: bytes):
+        writer.write(
+            (
+                f"HTTP/1.1 {code} {reason}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode("iso-8859-1")
+            + body
+        )
+        await writer.drain()
+
+    async def _send_blocked(self, writer, reason, url):
+        body = blocked_page(reason, url).encode("utf-8")
+        await self._send_simple(writer, 403, "Forbidden", "text/html", body)
+
+    async def _send_error(self, writer, code, message, url):
+        body = error_page(code, message, url).encode("utf-8")
+        await self._send_simple(writer, code, "Proxy Error", "text/html", body)
+
+    def _is_own_address(self, host, port) -> bool:
+        return port == self._own_port and host.lower().strip("[]") in self._own_hosts
+
+    async def _send_admin(self, writer):
+        rule_index = self.filter.rule_index
+        rules = rule_index.rules if rule_index is not None else []
+        client_tls = self.server_contexts.stats()
+        html = admin_page(
+            {
+                "Status": "Running",
+                "Engine": "asyncio",
+                "Open Connections": self.open_connections,
+                "Time": datetime.datetime.now(),
+            },
+            {
+                "Upstream Connections": {
+                    "created": self.upstreams_created,
+                    "reused": self.upstreams_reused,
+                    "idle": sum(len(idle) for idle in self._idle.values()),
+                },
+                "TLS": {
+                    **{f"client {k}": v for k, v in client_tls.items()},
+                    **{f"upstream {k}": v for k, v in upstream_tls.stats().items()},
+                },
+                "Content Inspection": inspection_policy.stats(),
+            },
+            [rule.pattern for rule in rules],
+        )
+        await self._send_simple(writer, 200, "OK", "text/html", html.encode("utf-8"))
+
+    async def _is_domain_blocked(self, domain, client_ip):
+        try:
+            return await self.filter.is_domain_blocked(domain.split(":")[0], client_ip)
+        except Exception as e:
+            logger.error(f"[BLOCK CHECK ERROR] {e}")
+            return False, ""
+
+    async def _handle_http(self, client, writer, request, client_ip) -> bool:
+        """Proxy one plain-HTTP request; returns whether the connection stays open."""
+        method, url, headers = request.method, request.target, request.headers
+
+        # Handle proxy admin interface
+        if url.startswith("/proxy-admin"):
+            await self._send_admin(writer)
+            return False
+
+        # Ensure URL is absolute
+        if not url.startswith("http"):
+            url = f"http://{headers.get('Host', 'localhost')}{url}"
+
+        logger.info(f"[{datetime.datetime.now()}] {method} {url} from {client_ip}")
+
+        parsed_url = urllib.parse.urlparse(url)
+        default_port = 443 if parsed_url.scheme == "https" else 80
+        port = parsed_url.port or default_port
+        if self._is_own_address(parsed_url.hostname or "", port):
+            # Forwarding to ourselves would feed the request straight back in
+            logger.warning(f"[ASYNC] refusing request to the proxy itself: {url}")
+            await self._send_error(writer, 508, "Loop Detected", url)
+            return False
+
+        is_blocked, block_reason = await self._is_domain_blocked(
+            parsed_url.netloc, client_ip
+        )
+        if is_blocked:
+            await self._send_blocked(writer, block_reason, url)
+            return False
+
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += f"?{parsed_url.query}"
+        origin = (parsed_url.scheme, parsed_url.hostname or "", port)
+        return await self._proxy_request(client, writer, request, url, origin, path)
+
+    async def _proxy_request(
+        self, client, writer, request, url, origin: Origin, target, upstream=None
+    ) -> bool:
+        """Answer one request from the cache or the origin.
+
+        ``upstream`` pins the request to a connection (a MITM tunnel's);
+        otherwise one is taken from the idle pool. Returns whether the
+        client connection stays open.
+        """
+        # Before the cache lookup, so variants are stored and found under one key
+        self._limit_accept_encoding(request.headers)
+        if request.method == "GET":
+            cached = await self._blocking(self.cache.get, url, dict(request.headers))
+            if cached is not None:
+                async for _ in client.iter_body():
+                    pass
+                await self._send_cached(writer, cached)
+                return request.keep_alive
+
+        pooled = upstream is None
+        try:
+            upstream, response = await self._forward_request(
+                origin, target, request, client, writer, upstream
+            )
+        except Exception as e:
+            logger.error(f"[FORWARD ERROR] {e}")
+            await self._send_error(writer, 502, "Bad Gateway", url)
+            return False
+
+        logger.info(f"[UPSTREAM] {response.status} {response.reason} for {url}")
+        if response.status == 101:
+            await self._relay_upgrade(client, writer, response, upstream)
+            return False
+
+        reusable = False
+        try:
+            keep_alive, reusable = await self._relay_response(
+                writer, request, response, upstream, url
+            )
+        finally:
+            if pooled:
+                self._release_upstream(upstream, reusable)
+
+        if request.method != "GET" and response.status < 400:
+            await self._blocking(self.cache.invalidate, url)
+        # A pinned upstream cannot be replaced, so the tunnel ends with it
+        return keep_alive and (pooled or reusable)
+
+    def _limit_accept_encoding(self, headers):
+        """Only offer the origin codings the content filter can decode."""
+        accept_encoding = headers.get("Accept-Encoding")
+        if accept_encoding is None or not len(self.filter.keyword_matcher):
+            return
+        del headers["Accept-Encoding"]
+        headers["Accept-Encoding"] = inspectable_encodings(accept_encoding)
+
+    async def _send_cached(self, writer, cached_data):
+        """Answer a request from the cache."""
+        body_file = cached_data.get("body_file")
+        if body_file is not None:
+            content = b""
+            content_length = cached_data["content_length"]
+        else:
+            content = cached_data.get("content") or b""
+            content_length = len(content)
+
+        status = f"{cached_data['status_code']} {cached_data.get('reason', '')}"
+        head = [f"HTTP/1.1 {status}"]
+        for key, value in cached_data.get("headers", {}).items():
+            if key.lower() not in ["connection", "transfer-encoding", "content-length"]:
+                head.append(f"{key}: {value}")
+        head.append(f"Content-Length: {content_length}")
+        head.append("X-Proxy-Cache: HIT")
+
+        try:
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("iso-8859-1"))
+            if body_file is not None and content_length:
+                await writer.drain()
+                # Zero-copy on plain transports; over TLS asyncio falls back to
+                # reading the file in the executor
+                await self._loop.sendfile(
+                    writer.transport, body_file, 0, content_length
+                )
+            else:
+                writer.write(content)
+            await writer.drain()
+        finally:
+            if body_file is not None:
+                body_file.close()
+
+    async def _blocking(self, func, *args):
+        """Run a call that touches the disk (the cache) off the event loop."""
+        return await self._loop.run_in_executor(None, func, *args)
+
+    def _request_head(self, request, target: str) -> bytes:
+        """Build the head sent upstream, restating the framing of the body."""
+        lines = [f"{request.method} {target} HTTP/1.1"]
+        # Kept for a protocol switch (e.g. WebSocket); _relay_upgrade passes the 101 on
+        skip = HOP_BY_HOP_HEADERS
+        if "upgrade" in request.headers.get("Connection", "").lower():
+            skip = skip - {"connection", "upgrade"}
+        for key, value in request.headers.items():
+            name = key.lower()
+            if name in skip or name in ("content-length", "expect"):
+                continue
+            lines.append(f"{key}: {value}")
+        # Restate the framing the client sent, using the length the parser validated
+        if request.chunked:
+            lines.append("Transfer-Encoding: chunked")
+        elif request.content_length is not None:
+            lines.append(f"Content-Length: {request.content_length}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+    async def _forward_request(
+        self, origin: Origin, target, request, client, writer, upstream=None
+    ):
+        """Send a request upstream, streaming its body; returns ``(upstream, head)``.
+
+        A request without a body is retried once on a fresh connection when
+        a pooled one turns out to have been closed by the origin.
+        """
+        if "100-continue" in request.headers.get("Expect", "").lower():
+            # The body is streamed before the origin answers, so confirm it ourselves
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        head = self._request_head(request, target)
+        if request.framing == "none":
+            # Consume the EndOfMessage so the next request head comes up after it
+            await client.next_event()
+        if upstream is not None:
+            return upstream, await self._exchange(
+                upstream, head, request, client, self.mitm_read_timeout
+            )
+
+        fresh = False
+        while True:
+            upstream, reused = await self._acquire_upstream(origin, fresh)
+            try:
+                return upstream, await self._exchange(
+                    upstream, head, request, client, self.upstream_timeout
+                )
+            except (ConnectionError, ProtocolError) as e:
+                upstream.close()
+                if not reused or request.framing != "none":
+                    raise
+                logger.debug(f"[FORWARD] stale pooled connection to {origin[1]}: {e}")
+                fresh = True
+            except BaseException:
+                upstream.close()
+                raise
+
+    async def _exchange(
+        self, upstream: _Upstream, head: bytes, request, client, timeout
+    ):
+        """Write one request to the origin and return its final response head.
+
+        ``timeout`` bounds the wait for each response head; None waits
+        indefinitely.
+        """
+        upstream.responses.parser.expect(request.method)
+        upstream.writer.write(head)
+        if request.framing != "none":
+            async for piece in client.iter_body():
+                upstream.writer.write(encode_chunk(piece) if request.chunked else piece)
+                await upstream.writer.drain()
+            if request.chunked:
+                upstream.writer.write(LAST_CHUNK)
+        await upstream.writer.drain()
+
+        while True:
+            response = await asyncio.wait_for(
+                upstream.responses.next_event(), timeout
+            )
+            if response is None:
+                raise ConnectionError("upstream closed before responding")
+            if response.status == 101:
+                if not client.parser.paused:
+                    raise ProtocolError("origin switched protocols unasked")
+                return response
+            if response.status >= 200:
+                return response
+            # Interim 1xx response; its EndOfMessage is already queued
+            await upstream.responses.next_event()
+
+    async def _relay_response(self, writer, request, response, upstream, url):
+        """Stream a response to the client; returns ``(keep_alive, reusable)``."""
+        body = upstream.responses.iter_body()
+        prefix = b""
+        scanner = self._content_scanner(
+            urllib.parse.urlsplit(url).hostname or "",
+            response.headers,
+            response.content_length,
+        )
+        if scanner is None:
+            body = self._count_skipped(body)
+        else:
+            # Held back while scanned, so an early match still gets the block page
+            body = self._scan_body(body, scanner)
+            try:
+                prefix = await self._read_body_prefix(body, self.max_buffered_body)
+            except ContentBlockedError as e:
+                logger.warning(f"[FILTER] blocked {url}: {e.reason}")
+                await self._send_blocked(writer, "Content filtered", url)
+                return False, False
+
+        # Bodies without a length are re-chunked for HTTP/1.1 clients; for
+        # older ones the end of the body is marked by closing the connection
+        unframed = response.framing in ("chunked", "eof")
+        rechunk = unframed and request.version == "HTTP/1.1"
+        keep_alive = request.keep_alive and (rechunk or not unframed)
+
+        spool = None
+        if request.method == "GET":
+            response_data = {
+                "status_code": response.status,
+                "reason": response.reason,
+                "headers": dict(response.headers),
+                "content_type": response.headers.get("Content-Type", ""),
+                "content_encoding": response.headers.get("Content-Encoding", ""),
+                "content_length": response.content_length,
+            }
+            spool = await self._blocking(
+                self.cache.open_writer, url, response_data, dict(request.headers)
+            )
+            del response.headers["X-Proxy-Cache"]
+            response.headers["X-Proxy-Cache"] = "MISS"
+
+        lines = [f"HTTP/1.1 {response.status} {response.reason}"]
+        for key, value in response.headers.items():
+            if key.lower() not in HOP_BY_HOP_HEADERS:
+                lines.append(f"{key}: {value}")
+        if rechunk:
+            lines.append("Transfer-Encoding: chunked")
+        if not keep_alive:
+            lines.append("Connection: close")
+        elif request.version != "HTTP/1.1":
+            lines.append("Connection: keep-alive")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1"))
+
+        try:
+            if prefix:
+                if spool is not None:
+                    await self._blocking(spool.write, prefix)
+                writer.write(encode_chunk(prefix) if rechunk else prefix)
+            async for piece in body:
+                if spool is not None:
+                    await self._blocking(spool.write, piece)
+                writer.write(encode_chunk(piece) if rechunk else piece)
+                await writer.drain()
+        except ContentBlockedError as e:
+            if spool is not None:
+                await self._blocking(spool.abort)
+            # Headers are already out; all we can do is cut the connection
+            logger.warning(f"[FILTER] aborted streamed response for {url}: {e.reason}")
+            return False, False
+        except BaseException:
+            if spool is not None:
+                await self._blocking(spool.abort)
+            raise
+        finally:
+            await body.aclose()
+        if spool is not None:
+            await self._blocking(spool.commit)
+        if rechunk:
+            writer.write(LAST_CHUNK)
+        await writer.drain()
+        return keep_alive, response.keep_alive
+
+    def _content_scanner(self, host, headers, content_length):
+        """Return a scanner for the part of a response the policy inspects, if any."""
+        if not len(self.filter.keyword_matcher):
+            return None
+        rule = inspection_policy.decide(
+            host, headers.get("Content-Type", ""), content_length
+        )
+        if rule.action == SKIP:
+            return None
+        # Compressed bodies are decoded for the matcher; the client gets them as sent
+        scanner = StreamingContentScanner(
+            self.filter,
+            headers.get("Content-Encoding", ""),
+            max_decoded=self.max_decoded_body,
+            scan_limit=rule.scan_limit,
+            sample_interval=rule.sample_interval,
+        )
+        return scanner if scanner.inspecting else None
+
+    @staticmethod
+    async def _scan_body(chunks, scanner):
+        """Pass body chunks through a scanner, yielding only the bytes it releases."""
+        try:
+            async for chunk in chunks:
+                data = scanner.feed(chunk)
+                if data:
+                    yield data
+            data = scanner.finish()
+            if data:
+                yield data
+        finally:
+            inspection_policy.record(scanner.scanned, scanner.skipped)
+
+    @staticmethod
+    async def _count_skipped(chunks):
+        skipped = 0
+        try:
+            async for chunk in chunks:
+                skipped += len(chunk)
+                yield chunk
+        finally:
+            inspection_policy.record(0, skipped)
+
+    @staticmethod
+    async def _read_body_prefix(chunks, limit) -> bytes:
+        """Buffer up to limit bytes of a body, leaving the rest in chunks."""
+        prefix = bytearray()
+        async for chunk in chunks:
+            prefix += chunk
+            if len(prefix) > limit:
+                break
+        return bytes(prefix)
+
+    async def _acquire_upstream(
+        self, origin: Origin, fresh: bool = False
+    ) -> Tuple[_Upstream, bool]:
+        """Reuse an idle connection to the origin or open one.
+
+        Returns ``(upstream, reused)``.
+        """
+        now = self._loop.time()
+        if now - self._last_sweep > self.upstream_idle_timeout / 2:
+            self._sweep_idle(now)
+
+        idle = self._idle.get(origin, [])
+        while idle and not fresh:
+            upstream = idle.pop()
+            if upstream.usable:
+                self.upstreams_reused += 1
+                return upstream, True
+            upstream.close()
+
+        scheme, host, port = origin
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host,
+                port,
+                ssl=self._insecure_context if scheme == "https" else None,
+                server_hostname=host if scheme == "https" else None,
+                limit=MAX_HEADER_SIZE,
+            ),
+            self.upstream_timeout,
+        )
+        self.upstreams_created += 1
+        return _Upstream(origin, reader, writer), False
+
+    def _release_upstream(self, upstream: _Upstream, reusable: bool):
+        """Keep a connection whose response was fully read for the next request."""
+        idle = self._idle.setdefault(upstream.origin, [])
+        if reusable and upstream.usable and len(idle) < self.max_idle_per_host:
+            upstream.idle_since = self._loop.time()
+            idle.append(upstream)
+        else:
+            upstream.close()
+
+    def _sweep_idle(self, now: float):
+        self._last_sweep = now
+        for origin, idle in list(self._idle.items()):
+            keep = [u for u in idle if now - u.idle_since < self.upstream_idle_timeout]
+            for upstream in idle:
+                if upstream not in keep:
+                    upstream.close()
+            if keep:
+                self._idle[origin] = keep
+            else:
+                del self._idle[origin]
+
+    async def _relay_upgrade(self, client, writer, response, upstream):
+        """Pass a 101 on and relay both directions untouched until either closes."""
+        try:
+            writer.write(serialize_head(response.start_line, response.headers))
+            await upstream.responses.next_event()
+            writer.write(upstream.responses.take_upgraded())
+            upstream.writer.write(client.parser.take_paused())
+            await asyncio.gather(
+                self._pipe(client.reader, upstream.writer, "C->S"),
+                self._pipe(upstream.responses.reader, writer, "S->C"),
+            )
+        finally:
+            upstream.close()
+
+    def _should_intercept(self, host: str) -> bool:
+        """Decide whether a CONNECT tunnel is decrypted or relayed blindly."""
+        if host_matches(host, self.passthrough_hosts):
+            return False
+        if self.mitm_mode == "never":
+            return False
+        if self.mitm_mode == "auto":
+            # Only content rules need to see inside a tunnel; domain rules were
+            # already applied to the CONNECT itself
+            return bool(self.filter.blocked_keywords)
+        return True
+
+    async def _server_context(self, host):
+        context = self.server_contexts.peek(host)
+        if context is None:
+            # Minting and loading the certificate is blocking, keep it off the event loop
+            context = await asyncio.get_running_loop().run_in_executor(
+                None, self.server_contexts.get, host
+            )
+        return context
+
+    async def _handle_connect(self, reader, writer, target, client_ip, early_data=b""):
+        host_port = target.split(":")
+        if len(host_port) == 2:
+            host, port = host_port[0], int(host_port[1])
+        else:
+            host, port = host_port[0], 443
+
+        logger.info(f"[{datetime.datetime.now()}] CONNECT {host}:{port} from {client_ip}")
+
+        if self._is_own_address(host, port):
+            logger.warning(f"[ASYNC] refusing CONNECT to the proxy itself: {target}")
+            await self._send_error(writer, 508, "Loop Detected", target)
+            return
+
+        traffic_log_writer.log("CONNECT", host, client_ip)
+
+        is_blocked, block_reason = await self._is_domain_blocked(host, client_ip)
+        if is_blocked:
+            await self._send_simple(
+                writer,
+                403,
+                "Forbidden",
+                "text/plain",
+                f"CONNECT blocked: {block_reason}".encode(),
+            )
+            return
+
+        intercept = self._should_intercept(host)
+        try:
+            if intercept:
+                client_context = await self._server_context(host)
+
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                asyncio.open_connection(
+                    host,
+                    port,
+                    ssl=upstream_tls.context if intercept else None,
+                    server_hostname=host if intercept else None,
+                    limit=MAX_HEADER_SIZE,
+                ),
+                timeout=self.upstream_timeout,
+            )
+        except Exception as e:
+            logger.error(f"[CONNECT ERROR] {e}")
+            await self._send_simple(
+                writer,
+                502,
+                "Bad Gateway",
+                "text/plain",
+                f"Connection failed: {str(e)}".encode(),
+            )
+            return
+
+        writer.write(b"HTTP/1.1 200 Connection established\r\n\r\n")
+        await writer.drain()
+
+        try:
+            if not intercept:
+                logger.info(f"[PASSTHROUGH] {host}:{port}")
+                if early_data:
+                    upstream_writer.write(early_data)
+                await asyncio.gather(
+                    self._pipe(reader, upstream_writer, "C->S"),
+                    self._pipe(upstream_reader, writer, "S->C"),
+                )
+                return
+
+            if early_data:
+                # The TLS handshake cannot start from bytes already consumed
+                raise ConnectionError("client sent data before the tunnel was up")
+            await writer.start_tls(client_context)
+            self.server_contexts.record_handshake(writer.get_extra_info("ssl_object"))
+            logger.info(f"TLS handshake completed with client for {host}")
+
+            authority = target if len(host_port) == 2 else host
+            upstream = _Upstream(
+                ("https", host, port), upstream_reader, upstream_writer
+            )
+            await self._mitm_tunnel(reader, writer, authority, client_ip, upstream)
+        finally:
+            upstream_writer.close()
+
+    async def _mitm_tunnel(self, reader, writer, authority, client_ip, upstream):
+        """Serve the decrypted requests of a tunnel like plain-HTTP ones.
+
+        Every request gets the domain check, traffic log, cache and content
+        filter; all of them go to the origin over the tunnel's own upstream
+        connection.
+        """
+        client = AsyncMessageReader(reader, HTTPParser(is_response=False), READ_SIZE)
+        while True:
+            request = await client.next_event()
+            if request is None:
+                return
+            method = request.method
+            url = f"https://{authority}{request.target}"
+            logger.info(f"[HTTPS REQUEST] {method} {url}")
+            traffic_log_writer.log(method, url, client_ip)
+
+            # The Host header, not the CONNECT target, names the site being asked for
+            host = request.headers.get("Host", authority)
+            is_blocked, block_reason = await self._is_domain_blocked(host, client_ip)
+            if is_blocked:
+                logger.warning(f"[MITM] blocked {url}: {block_reason}")
+                await self._send_blocked(writer, block_reason, url)
+                return
+
+            if not await self._proxy_request(
+                client, writer, request, url, upstream.origin, request.target, upstream
+            ):
+                return
+            if client.parser.paused:
+                # The upgrade was not passed on; parse what was held back
+                client.push(client.parser.resume())
+
+    async def _pipe(self, source, destination, direction):
+        """Copy bytes from one stream to the other until either side closes."""
+        try:
+            while True:
+                data = await source.read(READ_SIZE)
+                if not data:
+                    break
+                destination.write(data)
+                await destination.drain()
+        except Exception as e:
+            logger.info(f"[TUNNEL {direction}] closed: {e}")
+        finally:
+            try:
+                if destination.can_write_eof():
+                    destination.write_eof()
+                else:
+                    destination.close()
+            except Exception:
+                pass
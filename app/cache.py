@@ -0,0 +1,529 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import BinaryIO, Dict, List, Optional, Set
+
+from utils.logger import logger
+
+# Status codes a shared cache may store when the response allows it
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+
+# Heuristic freshness (10% of the Last-Modified age) never exceeds a day
+MAX_HEURISTIC_LIFETIME = 24 * 3600
+
+
+def _header(headers, name: str, default: str = "") -> str:
+    """Case-insensitive lookup on a plain header dict."""
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+def _http_date(value: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+    for part in value.split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def freshness_lifetime(headers, now: float) -> float:
+    """Seconds a response stays fresh in a shared cache (RFC 9111 section 4.2.1)."""
+    cache_control = parse_cache_control(_header(headers, "Cache-Control"))
+    for directive in ("s-maxage", "max-age"):
+        if directive in cache_control:
+            try:
+                return max(0, int(cache_control[directive] or 0))
+            except ValueError:
+                return 0
+
+    date = _http_date(_header(headers, "Date")) or now
+    expires = _header(headers, "Expires")
+    if expires:
+        # An invalid Expires means "already expired"
+        expires_at = _http_date(expires)
+        return max(0, expires_at - date) if expires_at else 0
+
+    last_modified = _http_date(_header(headers, "Last-Modified"))
+    if last_modified and last_modified < date:
+        return min((date - last_modified) / 10, MAX_HEURISTIC_LIFETIME)
+
+    return 0
+
+
+def _age(headers) -> int:
+    age = _header(headers, "Age").strip()
+    return int(age) if age.isdigit() else 0
+
+
+def _vary_names(headers) -> List[str]:
+    return sorted(
+        name.strip().lower()
+        for name in _header(headers, "Vary").split(",")
+        if name.strip()
+    )
+
+
+def _vary_values(names: List[str], request_headers) -> List[str]:
+    return [" ".join(_header(request_headers, name).split()) for name in names]
+
+
+@dataclass
+class CacheEntry:
+    url: str
+    status_code: int
+    reason: str
+    headers: Dict[str, str]
+    vary_names: List[str]
+    vary_values: List[str]
+    stored_at: float
+    expires_at: float
+    size: int
+    content: Optional[bytes] = field(default=None, repr=False)
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+    def to_response(self, now: float) -> dict:
+        headers = dict(self.headers)
+        headers["Age"] = str(_age(self.headers) + int(now - self.stored_at))
+        return {
+            "status_code": self.status_code,
+            "reason": self.reason,
+            "headers": headers,
+            "content": self.content,
+        }
+
+
+class MemoryTier:
+    """Byte-bounded LRU of cache entries with their bodies held in memory."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        self.discard(key)
+        if entry.size > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.size
+            self.evictions += 1
+
+    def discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskTier:
+    """Size-bounded store of cache entries as ``<key>.meta`` + ``<key>.body`` files."""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = 0
+        # key -> body size, least recently used first
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self.evictions = 0
+        self._load_index()
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.{suffix}")
+
+    def _load_index(self):
+        if not os.path.isdir(self.cache_dir):
+            return
+        found = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".meta"):
+                continue
+            key = name[: -len(".meta")]
+            body_path = self._path(key, "body")
+            try:
+                stat = os.stat(body_path)
+            except OSError:
+                continue
+            found.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(found):
+            self._index[key] = size
+            self.size += size
+        self._shrink()
+
+    def load_meta(self, key: str) -> Optional[CacheEntry]:
+        if key not in self._index:
+            return None
+        try:
+            with open(self._path(key, "meta"), "r", encoding="utf-8") as f:
+                entry = CacheEntry(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            self.discard(key)
+            return None
+        self._index.move_to_end(key)
+        return entry
+
+    def load_body(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key, "body"), "rb") as f:
+                return f.read()
+        except OSError:
+            self.discard(key)
+            return None
+
+    def open_body(self, key: str) -> Optional[BinaryIO]:
+        """Open a body file; the handle stays valid even if the entry is evicted."""
+        try:
+            return open(self._path(key, "body"), "rb")
+        except OSError:
+            self.discard(key)
+            return None
+
+    def put(self, key: str, entry: CacheEntry, body_path: str):
+        """Adopt a fully written body file and record the entry's metadata."""
+        if entry.size > self.max_bytes:
+            os.remove(body_path)
+            return
+        meta = asdict(entry)
+        meta["content"] = None
+
+        # Write-then-rename so readers never see a partial file
+        os.replace(body_path, self._path(key, "body"))
+        tmp_path = self._path(key, "meta.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(meta))
+        os.replace(tmp_path, self._path(key, "meta"))
+
+        self.size -= self._index.pop(key, 0)
+        self._index[key] = entry.size
+        self.size += entry.size
+        self._shrink()
+
+    def discard(self, key: str):
+        self.size -= self._index.pop(key, 0)
+        for suffix in ("meta", "body"):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def _shrink(self):
+        while self.size > self.max_bytes and self._index:
+            key = next(iter(self._index))
+            self.discard(key)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._index)
+
+
+class CacheWriter:
+    """Spools a response body into the cache directory while it is relayed.
+
+    Bodies never have to be held whole in memory: they go straight to a temp
+    file that ``commit`` hands to the disk tier. Small bodies are also kept in
+    memory so they can enter the memory tier.
+    """
+
+    def __init__(self, cache: "HTTPCache", url, response_data, request_headers, lifetime):
+        self.cache = cache
+        self.url = url
+        self.response_data = response_data
+        self.request_headers = dict(request_headers)
+        self.lifetime = lifetime
+        self.size = 0
+
+        os.makedirs(cache.cache_dir, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(
+            dir=cache.cache_dir, suffix=".tmp", delete=False
+        )
+        self._memory: Optional[bytearray] = bytearray()
+
+    def write(self, chunk):
+        if self._file is None:
+            return
+        if self.size + len(chunk) > self.cache.max_entry_size:
+            # Too large to cache; stop collecting
+            self.abort()
+            return
+        self._file.write(chunk)
+        self.size += len(chunk)
+        if self._memory is not None:
+            if self.size > self.cache.memory_entry_limit:
+                self._memory = None
+            else:
+                self._memory += chunk
+
+    def commit(self) -> bool:
+        if self._file is None:
+            return False
+        self._file.close()
+        path, self._file = self._file.name, None
+        content = bytes(self._memory) if self._memory is not None else None
+        return self.cache._commit(self, path, content)
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except OSError:
+            pass
+        self._file = None
+
+
+class HTTPCache:
+    """Two-tier shared HTTP response cache: memory LRU in front of a disk store.
+
+    Responses are stored only when their headers give them a freshness
+    lifetime (``s-maxage``, ``max-age``, ``Expires`` or a Last-Modified
+    heuristic) and nothing forbids it (``no-store``, ``private``,
+    ``no-cache``, ``Vary: *``, cookies). Entries are keyed by URL plus the
+    request header values named by the response's ``Vary``.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = "cache",
+        memory_bytes: int = 64 * 1024 * 1024,
+        disk_bytes: int = 1024 * 1024 * 1024,
+        max_entry_size: int = 256 * 1024 * 1024,
+        memory_entry_limit: int = 1024 * 1024,
+    ):
+        self.cache_dir = cache_dir
+        self.max_entry_size = max_entry_size
+        # Larger bodies live on disk only and are served without copying
+        self.memory_entry_limit = memory_entry_limit
+        self.memory = MemoryTier(memory_bytes)
+        self.disk = DiskTier(cache_dir, disk_bytes)
+        self._lock = threading.Lock()
+        # url -> request header names its stored response varies on
+        self._vary: Dict[str, List[str]] = {}
+        # url -> keys of its stored variants
+        self._variants: Dict[str, Set[str]] = {}
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+        for key in list(self.disk._index):
+            entry = self.disk.load_meta(key)
+            if entry is not None:
+                self._vary[entry.url] = entry.vary_names
+                self._variants.setdefault(entry.url, set()).add(key)
+
+    @staticmethod
+    def _key(url: str, vary_values: List[str]) -> str:
+        return hashlib.sha256("\n".join([url, *vary_values]).encode()).hexdigest()
+
+    def get(self, url: str, request_headers) -> Optional[dict]:
+        """Return a fresh cached response for the request, or None."""
+        request_cc = parse_cache_control(_header(request_headers, "Cache-Control"))
+        bypass = (
+            "no-cache" in request_cc
+            or request_cc.get("max-age") == "0"
+            or "no-cache" in _header(request_headers, "Pragma").lower()
+        )
+
+        now = time.time()
+        with self._lock:
+            names = self._vary.get(url)
+            if bypass or names is None:
+                self.misses += 1
+                return None
+
+            key = self._key(url, _vary_values(names, request_headers))
+            entry = self.memory.get(key)
+            if entry is not None:
+                tier = "memory"
+            else:
+                entry = self.disk.load_meta(key)
+                tier = "disk"
+
+            if entry is None or not entry.is_fresh(now):
+                if entry is not None:
+                    self.memory.discard(key)
+                    self.disk.discard(key)
+                self.misses += 1
+                return None
+
+            body_file = None
+            if entry.content is None:
+                if entry.size <= self.memory_entry_limit:
+                    entry.content = self.disk.load_body(key)
+                    found = entry.content is not None
+                    if found:
+                        self.memory.put(key, entry)
+                else:
+                    body_file = self.disk.open_body(key)
+                    found = body_file is not None
+                if not found:
+                    self.misses += 1
+                    return None
+
+            self.hits += 1
+            if tier == "memory":
+                self.memory_hits += 1
+            else:
+                self.disk_hits += 1
+
+        response = entry.to_response(now)
+        if body_file is not None:
+            # Caller streams the file (sendfile / mmap) and must close it
+            response["body_file"] = body_file
+            response["content_length"] = entry.size
+        return response
+
+    def storable_lifetime(self, response_data: dict, request_headers) -> float:
+        """Seconds a response may be served from cache, or 0 if it must not be stored."""
+        headers = response_data.get("headers", {})
+        if response_data.get("status_code") not in CACHEABLE_STATUS:
+            return 0
+
+        response_cc = parse_cache_control(_header(headers, "Cache-Control"))
+        request_cc = parse_cache_control(_header(request_headers, "Cache-Control"))
+        if {"no-store", "private", "no-cache"} & response_cc.keys():
+            return 0
+        if "no-store" in request_cc:
+            return 0
+        if _header(headers, "Set-Cookie"):
+            return 0
+        if _header(request_headers, "Authorization") and not (
+            {"public", "s-maxage", "must-revalidate"} & response_cc.keys()
+        ):
+            return 0
+        if "*" in _vary_names(headers):
+            return 0
+
+        return max(0, freshness_lifetime(headers, time.time()) - _age(headers))
+
+    def open_writer(self, url: str, response_data: dict, request_headers) -> Optional[CacheWriter]:
+        """Start storing a response whose body will be written incrementally."""
+        lifetime = self.storable_lifetime(response_data, request_headers)
+        if not lifetime:
+            return None
+        try:
+            return CacheWriter(self, url, response_data, request_headers, lifetime)
+        except OSError as e:
+            logger.warning(f"[CACHE] cannot spool {url}: {e}")
+            return None
+
+    def set(self, url: str, response_data: dict, request_headers) -> bool:
+        """Store a response with an in-memory body if HTTP caching rules allow it."""
+        content = response_data.get("content", b"")
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        writer = self.open_writer(url, response_data, request_headers)
+        if writer is None:
+            return False
+        writer.write(content)
+        return writer.commit()
+
+    def _commit(self, writer: CacheWriter, body_path: str, content: Optional[bytes]) -> bool:
+        url = writer.url
+        headers = writer.response_data.get("headers", {})
+        now = time.time()
+        vary_names = _vary_names(headers)
+        stored_headers = {
+            key: value
+            for key, value in headers.items()
+            if key.lower() not in ("connection", "keep-alive", "transfer-encoding")
+        }
+        vary_values = _vary_values(vary_names, writer.request_headers)
+        entry = CacheEntry(
+            url=url,
+            status_code=writer.response_data["status_code"],
+            reason=writer.response_data.get("reason", ""),
+            headers=stored_headers,
+            vary_names=vary_names,
+            vary_values=vary_values,
+            stored_at=now,
+            expires_at=now + writer.lifetime,
+            size=writer.size,
+            content=content,
+        )
+        key = self._key(url, vary_values)
+
+        with self._lock:
+            # A new Vary spec invalidates variants stored under the old one
+            old_names = self._vary.get(url)
+            if old_names is not None and old_names != vary_names:
+                self._invalidate_locked(url)
+            self._vary[url] = vary_names
+            self._variants.setdefault(url, set()).add(key)
+            if content is not None:
+                self.memory.put(key, entry)
+            else:
+                self.memory.discard(key)
+            try:
+                self.disk.put(key, entry, body_path)
+            except OSError as e:
+                logger.warning(f"[CACHE] failed to write {url} to disk: {e}")
+            self.stores += 1
+
+        logger.info(f"[CACHE] Stored {url} for {int(writer.lifetime)}s")
+        return True
+
+    def invalidate(self, url: str):
+        """Drop every stored variant of url, e.g. after an unsafe request."""
+        with self._lock:
+            self._invalidate_locked(url)
+
+    def _invalidate_locked(self, url: str):
+        self._vary.pop(url, None)
+        for key in self._variants.pop(url, ()):
+            self.memory.discard(key)
+            self.disk.discard(key)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.memory.evictions + self.disk.evictions,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory.size,
+                "disk_entries": len(self.disk),
+                "disk_bytes": self.disk.size,
+            }
+
+
+http_cache = HTTPCache()
@@ -1,62 +1,224 @@
 import datetime
+import ipaddress
 import os
+import threading
+import time
+from typing import Dict, List, Tuple
 
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+
+class CertificateAuthority:
+    """Issues leaf certificates signed by the proxy CA.
+
+    The CA key and certificate are parsed once. By default every leaf shares
+    one ECDSA P-256 key pair, so issuing a certificate costs a single signature
+    instead of a key generation; ``key_type="rsa"`` and ``reuse_key=False``
+    restore 2048-bit RSA keys and a fresh key per certificate.
+    """
+
+    def __init__(
+        self,
+        ca_cert: x509.Certificate,
+        ca_key,
+        key_type: str = "ec",
+        reuse_key: bool = True,
+        validity_days: int = 365,
+    ):
+        if key_type not in ("ec", "rsa"):
+            raise ValueError(f"Unknown key type: {key_type}")
+        self.ca_cert = ca_cert
+        self.ca_key = ca_key
+        self.key_type = key_type
+        self.reuse_key = reuse_key
+        self.validity_days = validity_days
+
+        self._leaf_key = None
+        # Serialized forms of the shared leaf key, by encoding
+        self._leaf_key_bytes: Dict[serialization.Encoding, bytes] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_files(cls, ca_cert_file: str, ca_key_file: str, **kwargs):
+        with open(ca_key_file, "rb") as f:
+            ca_key = serialization.load_pem_private_key(f.read(), password=None)
+        with open(ca_cert_file, "rb") as f:
+            ca_cert = x509.load_pem_x509_certificate(f.read())
+        return cls(ca_cert, ca_key, **kwargs)
+
+    def _generate_key(self):
+        if self.key_type == "ec":
+            return ec.generate_private_key(ec.SECP256R1())
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def _key(self):
+        if not self.reuse_key:
+            return self._generate_key()
+        with self._lock:
+            if self._leaf_key is None:
+                self._leaf_key = self._generate_key()
+            return self._leaf_key
+
+    def _key_bytes(self, key, encoding: serialization.Encoding) -> bytes:
+        if key is not self._leaf_key:
+            return _private_key_bytes(key, encoding)
+        with self._lock:
+            data = self._leaf_key_bytes.get(encoding)
+            if data is None:
+                data = self._leaf_key_bytes[encoding] = _private_key_bytes(key, encoding)
+            return data
+
+    def issue(
+        self, domain: str, wildcard: bool = False
+    ) -> Tuple[x509.Certificate, object]:
+        """Sign a certificate for domain; returns ``(certificate, private_key)``.
+
+        A ``wildcard`` certificate also covers every direct subdomain.
+        """
+        key = self._key()
+        return self._sign(domain, key, wildcard), key
+
+    def issue_pem(self, domain: str, wildcard: bool = False) -> Tuple[bytes, bytes]:
+        """Sign a certificate for domain; returns PEM ``(certificate, private_key)``."""
+        cert, key = self.issue(domain, wildcard)
+        return (
+            cert.public_bytes(serialization.Encoding.PEM),
+            self._key_bytes(key, serialization.Encoding.PEM),
+        )
+
+    def issue_der(
+        self, domain: str, wildcard: bool = False
+    ) -> Tuple[bytes, bytes, float]:
+        """Sign a certificate for domain; returns DER certificate and key plus expiry."""
+        cert, key = self.issue(domain, wildcard)
+        return (
+            cert.public_bytes(serialization.Encoding.DER),
+            self._key_bytes(key, serialization.Encoding.DER),
+            cert.not_valid_after_utc.timestamp(),
+        )
+
+    def _sign(self, domain: str, key, wildcard: bool = False) -> x509.Certificate:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        # No CSR: the subject and public key go straight into the certificate
+        return (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(x509.OID_COMMON_NAME, domain)]))
+            .issuer_name(self.ca_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=self.validity_days))
+            .add_extension(
+                x509.SubjectAlternativeName(_subject_alt_names(domain, wildcard)),
+                critical=False,
+            )
+            .sign(self.ca_key, hashes.SHA256())
+        )
+
+    def write(
+        self, domain: str, out_cert_file: str, out_key_file: str, wildcard: bool = False
+    ):
+        cert_pem, key_pem = self.issue_pem(domain, wildcard)
+
+        os.makedirs(os.path.dirname(out_key_file), exist_ok=True)
+        os.makedirs(os.path.dirname(out_cert_file), exist_ok=True)
+
+        with open(out_key_file, "wb") as f:
+            f.write(key_pem)
+        with open(out_cert_file, "wb") as f:
+            f.write(cert_pem)
+
+
+def _subject_alt_names(domain: str, wildcard: bool) -> List[x509.GeneralName]:
+    try:
+        # Clients match IP literals against IP SANs only
+        return [x509.IPAddress(ipaddress.ip_address(domain))]
+    except ValueError:
+        pass
+    names: List[x509.GeneralName] = [x509.DNSName(domain)]
+    if wildcard:
+        names.append(x509.DNSName(f"*.{domain}"))
+    return names
+
+
+def _private_key_bytes(key, encoding: serialization.Encoding) -> bytes:
+    return key.private_bytes(
+        encoding=encoding,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+
+# One authority per CA file pair, so the CA is parsed only once per process
+_authorities: Dict[Tuple[str, str], CertificateAuthority] = {}
+_authorities_lock = threading.Lock()
+
+
+def get_authority(ca_cert_file: str, ca_key_file: str) -> CertificateAuthority:
+    with _authorities_lock:
+        authority = _authorities.get((ca_cert_file, ca_key_file))
+        if authority is None:
+            authority = CertificateAuthority.from_files(ca_cert_file, ca_key_file)
+            _authorities[(ca_cert_file, ca_key_file)] = authority
+        return authority
 
 
 def generate_signed_cert(
-    domain, ca_cert_file, ca_key_file, out_cert_file, out_key_file
+    domain, ca_cert_file, ca_key_file, out_cert_file, out_key_file, wildcard=False
 ):
-    with open(ca_key_file, "rb") as f:
-        ca_key = serialization.load_pem_private_key(f.read(), password=None)
-    with open(ca_cert_file, "rb") as f:
-        ca_cert = x509.load_pem_x509_certificate(f.read())
+    get_authority(ca_cert_file, ca_key_file).write(
+        domain, out_cert_file, out_key_file, wildcard=wildcard
+    )
 
-    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
 
-    csr = (
-        x509.CertificateSigningRequestBuilder()
-        .subject_name(x509.Name([x509.NameAttribute(x509.OID_COMMON_NAME, domain)]))
-        .sign(key, hashes.SHA256())
-    )
+def mint_certificate(
+    domain, ca_cert_file, ca_key_file, wildcard=False
+) -> Tuple[bytes, bytes, float]:
+    """Issue a certificate for the keystore: DER certificate, DER key, expiry timestamp."""
+    return get_authority(ca_cert_file, ca_key_file).issue_der(domain, wildcard)
+
 
-    cert = (
+def _benchmark(count: int = 50):
+    """Print the time per issued certificate for each key strategy."""
+    ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    ca_name = x509.Name([x509.NameAttribute(x509.OID_COMMON_NAME, "Benchmark CA")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ca_cert = (
         x509.CertificateBuilder()
-        .subject_name(csr.subject)
-        .issuer_name(ca_cert.subject)
-        .public_key(csr.public_key())
+        .subject_name(ca_name)
+        .issuer_name(ca_name)
+        .public_key(ca_key.public_key())
         .serial_number(x509.random_serial_number())
-        .not_valid_before(datetime.datetime.now() - datetime.timedelta(days=1))
-        .not_valid_after(datetime.datetime.now() + datetime.timedelta(days=365))
-        .add_extension(
-            x509.SubjectAlternativeName([x509.DNSName(domain)]), critical=False
-        )
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
         .sign(ca_key, hashes.SHA256())
     )
 
-    os.makedirs(os.path.dirname(out_key_file), exist_ok=True)
-    os.makedirs(os.path.dirname(out_cert_file), exist_ok=True)
-
-    with open(out_key_file, "wb") as f:
-        f.write(
-            key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=serialization.NoEncryption(),
-            )
+    for key_type, reuse_key in (("rsa", False), ("ec", False), ("rsa", True), ("ec", True)):
+        authority = CertificateAuthority(
+            ca_cert, ca_key, key_type=key_type, reuse_key=reuse_key
         )
-
-    with open(out_cert_file, "wb") as f:
-        f.write(cert.public_bytes(serialization.Encoding.PEM))
+        authority.issue_pem("warmup.example.com")
+        start = time.perf_counter()
+        for i in range(count):
+            authority.issue_pem(f"host{i}.example.com")
+        elapsed = (time.perf_counter() - start) / count
+        label = f"{key_type}, {'shared' if reuse_key else 'fresh'} key"
+        print(f"{label:<20} {elapsed * 1000:8.2f} ms/cert")
 
 
 if __name__ == "__main__":
-    generate_signed_cert(
-        "www.example.com",
-        ca_cert_file="proxy_ca.crt",
-        ca_key_file="proxy_ca.key",
-        out_cert_file="certs/www.example.com.crt",
-        out_key_file="certs/www.example.com.key",
-    )
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--benchmark":
+        _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 50)
+    else:
+        generate_signed_cert(
+            "www.example.com",
+            ca_cert_file="proxy_ca.crt",
+            ca_key_file="proxy_ca.key",
+            out_cert_file="certs/www.example.com.crt",
+            out_key_file="certs/www.example.com.key",
+        )
@@ -2,6 +2,7 @@ import ipaddress
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional, Tuple
 
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
@@ -16,6 +17,15 @@ async def add_traffic_log(method: str, url: str, client_ip: str):
         await session.commit()
 
 
+async def add_traffic_logs(records: List[dict]) -> None:
+    """Insert many traffic log rows in a single executemany and transaction."""
+    if not records:
+        return
+    async with get_session() as session:
+        await session.execute(insert(TrafficLog), records)
+        await session.commit()
+
+
 async def get_all_traffic_logs(limit=100):
     async with get_session() as session:
         result = await session.execute(
@@ -0,0 +1,145 @@
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from utils.logger import logger
+
+from . import crud
+from .gateway import DBGateway, db_gateway
+
+# Sentinel pushed on close so the writer thread wakes up immediately
+_CLOSE = object()
+
+
+class TrafficLogWriter:
+    """Buffers traffic log records and writes them to the database in batches.
+
+    ``log`` never blocks the caller: records go into a bounded queue that a
+    background thread drains, inserting up to ``batch_size`` rows per
+    transaction or whatever arrived within ``flush_interval`` seconds. When the
+    queue is full new records are dropped and counted.
+    """
+
+    def __init__(
+        self,
+        gateway: DBGateway = db_gateway,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        write_timeout: float = 30,
+    ):
+        self.gateway = gateway
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.write_timeout = write_timeout
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+
+    def log(self, method: str, url: str, client_ip: str) -> bool:
+        """Queue one record for writing; returns False if it was dropped."""
+        if self._closed:
+            return False
+        self._ensure_thread()
+
+        record = {
+            "time": datetime.now(timezone.utc),
+            "method": method,
+            "url": url,
+            "client_ip": client_ip,
+        }
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+
+        with self._lock:
+            self.enqueued += 1
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "batches": self.batches,
+                "pending": self._queue.qsize(),
+            }
+
+    def close(self, timeout: Optional[float] = 10) -> None:
+        """Stop accepting records and flush everything still queued."""
+        self._closed = True
+        thread = self._thread
+        if thread is None:
+            return
+        # Blocking put: the queue may be full, but the writer is draining it
+        self._queue.put(_CLOSE)
+        thread.join(timeout)
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="traffic-log-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        batch: List[dict] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _CLOSE:
+                self._flush(batch)
+                return
+
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if len(batch) >= self.batch_size or (
+                deadline is not None and time.monotonic() >= deadline
+            ):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch: List[dict]):
+        if not batch:
+            return
+        try:
+            self.gateway.run(crud.add_traffic_logs(batch), timeout=self.write_timeout)
+        except Exception as e:
+            logger.error(f"[TRAFFIC LOG ERROR] failed to write {len(batch)} records: {e}")
+            with self._lock:
+                self.failed += len(batch)
+            return
+
+        with self._lock:
+            self.written += len(batch)
+            self.batches += 1
+
+
+traffic_log_writer = TrafficLogWriter()
@@ -0,0 +1,147 @@
+import zlib
+from typing import List
+
+try:
+    import brotli
+except ImportError:  # Optional: br bodies are passed on without inspection
+    brotli = None
+
+# Inspection stops once a body has decoded to this many bytes
+MAX_DECODED_SIZE = 32 * 1024 * 1024
+# br is only decoded with brotli >= 1.1, whose output_buffer_limit bounds what
+# one call can expand to; older versions would let a bomb inflate unchecked
+_BROTLI_BOUNDED = brotli is not None and hasattr(
+    brotli.Decompressor, "can_accept_more_data"
+)
+# Content codings ContentDecoder can undo
+SUPPORTED_CODINGS = ("identity", "gzip", "x-gzip", "deflate") + (
+    ("br",) if _BROTLI_BOUNDED else ()
+)
+
+
+class DecodingError(Exception):
+    """The body cannot (or can no longer) be decoded for inspection."""
+
+
+class _ZlibStage:
+    """gzip or deflate, including concatenated gzip members and raw deflate."""
+
+    def __init__(self, coding: str):
+        self.coding = coding
+        self._decompressor = None
+        # Leading deflate bytes kept until the zlib header can be recognised
+        self._head = b""
+
+    def _start(self, data: bytes):
+        if self.coding == "deflate":
+            # "deflate" means zlib-wrapped, but raw deflate streams are common
+            wrapped = (
+                len(data) >= 2
+                and data[0] & 0x0F == 8
+                and (data[0] << 8 | data[1]) % 31 == 0
+            )
+            wbits = zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS
+        else:
+            wbits = 16 + zlib.MAX_WBITS
+        return zlib.decompressobj(wbits)
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        output = bytearray()
+        if self._decompressor is None and self.coding == "deflate":
+            data = self._head + data
+            if len(data) < 2:
+                self._head = data
+                return b""
+            self._head = b""
+        while data:
+            if self._decompressor is None:
+                self._decompressor = self._start(data)
+            try:
+                # max_length caps the output, so a bomb stops at the limit
+                output += self._decompressor.decompress(data, limit - len(output) + 1)
+            except zlib.error as e:
+                raise DecodingError(f"corrupt {self.coding} body: {e}")
+            if len(output) > limit:
+                raise DecodingError("decoded size limit reached")
+            data = self._decompressor.unconsumed_tail
+            if not data and self._decompressor.eof:
+                data = self._decompressor.unused_data
+                if self.coding == "deflate":
+                    break
+                # Another gzip member follows
+                self._decompressor = None
+        return bytes(output)
+
+
+class _BrotliStage:
+    def __init__(self):
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data: bytes, limit: int) -> bytes:
+        output = bytearray()
+        try:
+            # output_buffer_limit caps the output, so a bomb stops at the limit;
+            # until the decompressor takes input again it is drained with b""
+            while True:
+                output += self._decompressor.process(
+                    data, output_buffer_limit=limit - len(output) + 1
+                )
+                if len(output) > limit:
+                    raise DecodingError("decoded size limit reached")
+                if self._decompressor.can_accept_more_data():
+                    break
+                data = b""
+        except brotli.error as e:
+            raise DecodingError(f"corrupt br body: {e}")
+        return bytes(output)
+
+
+class ContentDecoder:
+    """Undoes a response's Content-Encoding incrementally, for inspection only.
+
+    ``decode`` takes the encoded bytes as they arrive and returns whatever
+    plain text they complete. Codings listed together are undone in reverse
+    order. Output is capped at ``max_output`` bytes in total; past that, or
+    on a corrupt stream, ``decode`` raises DecodingError. Unsupported codings
+    raise it from the constructor.
+    """
+
+    def __init__(self, content_encoding: str, max_output: int = MAX_DECODED_SIZE):
+        self.max_output = max_output
+        self.output_size = 0
+        self._stages: List = []
+        codings = [c.strip().lower() for c in content_encoding.split(",")]
+        for coding in reversed(codings):
+            if coding in ("", "identity"):
+                continue
+            if coding not in SUPPORTED_CODINGS:
+                raise DecodingError(f"unsupported Content-Encoding: {coding}")
+            if coding == "br":
+                self._stages.append(_BrotliStage())
+            else:
+                self._stages.append(_ZlibStage("deflate" if coding == "deflate" else "gzip"))
+
+    def __bool__(self):
+        return bool(self._stages)
+
+    def decode(self, data) -> bytes:
+        data = bytes(data)
+        limit = self.max_output - self.output_size
+        for stage in self._stages:
+            data = stage.decompress(data, limit)
+        self.output_size += len(data)
+        return data
+
+
+def inspectable_encodings(accept_encoding: str) -> str:
+    """Narrow an Accept-Encoding value to the codings ContentDecoder can undo.
+
+    Forwarded in place of the client's value while keywords are configured,
+    so origins do not answer with a coding (br, zstd) the filter cannot read.
+    """
+    kept = [
+        item.strip()
+        for item in accept_encoding.split(",")
+        if item.split(";", 1)[0].strip().lower() in SUPPORTED_CODINGS
+    ]
+    return ", ".join(kept) or "identity"
@@ -1,9 +1,15 @@
+import asyncio
+from collections import deque
 from contextlib import asynccontextmanager
-from typing import Optional, List
+from typing import Deque, Optional, List, Tuple
 from datetime import datetime
 
 from app.db import crud
 from app.db.session import AsyncSessionLocal
+from app.decoding import MAX_DECODED_SIZE, ContentDecoder, DecodingError
+from app.matcher import KeywordMatcher
+from app.rule_index import DomainRuleIndex
+from utils.logger import logger
 
 
 @asynccontextmanager
@@ -12,6 +18,143 @@ async def get_db_session():
         yield session
 
 
+class ContentBlockedError(Exception):
+    """Raised by a streaming scanner when the body contains a blocked keyword."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class StreamingContentScanner:
+    """Runs the content filter's keyword matcher over a body as it arrives.
+
+    The matcher state is carried from chunk to chunk, so each byte is scanned
+    once and keywords split across chunks are still found. ``feed`` returns
+    the bytes that are safe to forward: the last ``hold_back`` bytes (one
+    less than the longest keyword) stay behind until more data arrives, so
+    no part of a keyword is released before it could be recognised.
+
+    Bodies with a ``content_encoding`` are decoded incrementally for the
+    matcher while the encoded bytes are what gets held and released; there
+    whole chunks are held until ``hold_back`` more decoded bytes follow them.
+    If the body cannot be decoded (or decodes past ``max_decoded``) the rest
+    passes through unscanned and ``inspecting`` turns False.
+
+    With ``scan_limit`` only the first that many (decoded) bytes are
+    scanned; adding ``sample_interval`` scans ``scan_limit`` bytes out of
+    every ``sample_interval`` instead. ``scanned`` and ``skipped`` count
+    the bytes that were and were not run through the matcher.
+    """
+
+    def __init__(
+        self,
+        content_filter: "ContentFilter",
+        content_encoding: str = "",
+        max_decoded: int = MAX_DECODED_SIZE,
+        scan_limit: Optional[int] = None,
+        sample_interval: Optional[int] = None,
+    ):
+        self.matcher = content_filter.keyword_matcher
+        self.hold_back = max(self.matcher.max_length - 1, 0)
+        self.scan_limit = scan_limit
+        self.sample_interval = sample_interval
+        self.inspecting = True
+        self.scanned = 0
+        self.skipped = 0
+        # Offset in the decoded body
+        self._position = 0
+        self._state = None
+        self._held = b""
+
+        self.decoder: Optional[ContentDecoder] = None
+        # Encoded chunks not yet released, with the decoded offset each ends at
+        self._held_chunks: Deque[Tuple[bytes, int]] = deque()
+        try:
+            self.decoder = ContentDecoder(content_encoding, max_decoded) or None
+        except DecodingError as e:
+            logger.debug(f"[FILTER] not scanning body: {e}")
+            self.inspecting = False
+
+    def feed(self, chunk) -> bytes:
+        if not self.inspecting:
+            self.skipped += len(chunk)
+            return bytes(chunk)
+
+        chunk = bytes(chunk)
+        text = chunk
+        if self.decoder is not None:
+            try:
+                text = self.decoder.decode(chunk)
+            except DecodingError as e:
+                logger.warning(f"[FILTER] {e}; rest of body not scanned")
+                self.inspecting = False
+                self.skipped += len(chunk)
+                return self.finish() + chunk
+
+        self._scan(text)
+        if not self.inspecting:
+            # Past the scan limit, everything held can go
+            return self.finish() + chunk
+
+        if self.decoder is None:
+            data = self._held + chunk
+            if not self.hold_back:
+                return data
+            self._held = data[-self.hold_back :]
+            return data[: -self.hold_back]
+
+        self._held_chunks.append((chunk, self._position))
+        released = []
+        while self._held_chunks and self._held_chunks[0][1] + self.hold_back <= self._position:
+            released.append(self._held_chunks.popleft()[0])
+        return b"".join(released)
+
+    def _scan(self, data):
+        if self.scan_limit is None:
+            self._search(data)
+            return
+
+        view = memoryview(data)
+        while view:
+            if self.sample_interval:
+                offset = self._position % self.sample_interval
+            else:
+                offset = self._position
+            if offset < self.scan_limit:
+                if offset == 0:
+                    # Keywords never span two samples
+                    self._state = None
+                piece = view[: self.scan_limit - offset]
+                self._search(piece)
+            else:
+                piece = view[: self.sample_interval - offset] if self.sample_interval else view
+                self.skipped += len(piece)
+                self._position += len(piece)
+            view = view[len(piece) :]
+
+        if not self.sample_interval and self._position >= self.scan_limit:
+            self.inspecting = False
+
+    def _search(self, data):
+        keyword, self._state = self.matcher.search(data, self._state)
+        self.scanned += len(data)
+        self._position += len(data)
+        if keyword is not None:
+            self.abort()
+            raise ContentBlockedError(f"Blocked keyword: {keyword}")
+
+    def finish(self) -> bytes:
+        """Release whatever is still held once the body has ended."""
+        held = self._held + b"".join(chunk for chunk, _ in self._held_chunks)
+        self.abort()
+        return held
+
+    def abort(self):
+        self._held = b""
+        self._held_chunks.clear()
+
+
 class ContentFilter:
     """Content filtering and blocking functionality."""
 
@@ -23,33 +166,60 @@ class ContentFilter:
             "virus",
             "adult",
         ]
+        # Compiled view of the active rules, swapped wholesale on every change
+        self.rule_index: Optional[DomainRuleIndex] = None
 
-    async def is_domain_blocked(self, host, client_ip: Optional[str] = None):
-        """Check if the host matches any active block rule from the database"""
+    @property
+    def blocked_keywords(self) -> List[str]:
+        return list(self.keyword_matcher.keywords)
+
+    @blocked_keywords.setter
+    def blocked_keywords(self, keywords):
+        # Assigning a new list recompiles the matcher used by every scan
+        self.keyword_matcher = KeywordMatcher(keywords)
+
+    async def refresh_rules(self) -> DomainRuleIndex:
+        """Rebuild the in-memory rule index from the database."""
         async with get_db_session() as session:
-            return await crud.is_domain_blocked(session, host, client_ip)
+            rules = await crud.get_active_rules(session)
+        # Compiling tens of thousands of rules takes a while; keep the loop free
+        self.rule_index = await asyncio.to_thread(DomainRuleIndex, rules)
+        return self.rule_index
+
+    async def is_domain_blocked(self, host, client_ip: Optional[str] = None):
+        """Check if the host matches any active block rule"""
+        rule_index = self.rule_index
+        if rule_index is None:
+            # An empty index is falsy, so test for None rather than truthiness
+            rule_index = await self.refresh_rules()
+        return rule_index.lookup(host, client_ip)
 
     def is_content_blocked(self, content):
-        """Check if content contains blocked keywords."""
-        if not content or not isinstance(content, str):
+        """Check if content (bytes or str) contains blocked keywords."""
+        if not content or not isinstance(content, (bytes, bytearray, memoryview, str)):
             return False, None
-        content_lower = content.lower()
-        for keyword in self.blocked_keywords:
-            if keyword in content_lower:
-                return True, f"Blocked keyword: {keyword}"
+        keyword = self.keyword_matcher.find(content)
+        if keyword is not None:
+            return True, f"Blocked keyword: {keyword}"
         return False, None
 
     async def add_block_rule(self, **kwargs):
         async with get_db_session() as session:
-            return await crud.add_blocked_domain(session, **kwargs)
+            rule = await crud.add_blocked_domain(session, **kwargs)
+        await self.refresh_rules()
+        return rule
 
     async def delete_block_rule(self, rule_id: int):
         async with get_db_session() as session:
-            return await crud.delete_rule(session, rule_id)
+            result = await crud.delete_rule(session, rule_id)
+        await self.refresh_rules()
+        return result
 
     async def update_block_rule(self, rule_id: int, **kwargs):
         async with get_db_session() as session:
-            return await crud.update_blocked_domain(session, rule_id, **kwargs)
+            rule = await crud.update_blocked_domain(session, rule_id, **kwargs)
+        await self.refresh_rules()
+        return rule
 
     async def list_block_rules(self):
         async with get_db_session() as session:
@@ -1,33 +1,157 @@
-import asyncio
 import datetime
-import hashlib
-import os
-import re
+import mmap
 import socket
 import ssl
+import tempfile
 import threading
 import urllib
-from http.client import HTTPConnection, HTTPSConnection
+from http import HTTPStatus
+from http.client import RemoteDisconnected
 from http.server import BaseHTTPRequestHandler
 from typing import Optional
 
-from app.db import crud
-from app.filter import ContentFilter
+from app.cache import http_cache
+from app.db.gateway import db_gateway
+from app.db.log_writer import traffic_log_writer
+from app.decoding import inspectable_encodings
+from app.filter import ContentBlockedError, ContentFilter, StreamingContentScanner
+from app.http_codec import (
+    LAST_CHUNK,
+    EndOfMessage,
+    HTTPParser,
+    MessageReader,
+    ProtocolError,
+    encode_chunk,
+    iter_file_body,
+    parse_content_length,
+    serialize_head,
+)
+from app.inspection import SKIP, inspection_policy
+from app.relay import relay
+from app.responses import admin_page, blocked_page, error_page
+from app.rule_index import host_matches
+from app.tls import server_contexts, upstream_tls
+from app.upstream import upstream_pool
 from utils.logger import logger
 
+# Seconds a handler thread waits on the database gateway before giving up
+DB_TIMEOUT = 10
+
+
+class _CacheCollector:
+    """Streaming consumer that spools a relayed response into the cache."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def feed(self, chunk):
+        self.writer.write(chunk)
+
+    def finish(self):
+        self.writer.commit()
+
+    def abort(self):
+        self.writer.abort()
+
 
 class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
     """HTTP request handler for proxy server."""
 
+    # Persistent client connections; every response carries explicit framing
+    protocol_version = "HTTP/1.1"
+    # Seconds an idle keep-alive connection waits for its next request
+    keep_alive_timeout = 15
+    # Requests served on one client connection before it is closed
+    max_keep_alive_requests = 100
+
+    # Keep-alive connections to origins, shared by every handler thread
+    upstream_pool = upstream_pool
+    # Memory + disk response cache, shared by every handler thread
+    cache = http_cache
+    # LRU of per-host MITM server contexts, shared by every handler thread
+    server_contexts = server_contexts
+    # Upstream TLS context and per-origin sessions for resumption
+    upstream_tls = upstream_tls
+    # CONNECT handling: "always" decrypts every tunnel, "auto" only when content
+    # rules need to see inside it, "never" relays every tunnel untouched
+    mitm_mode = "always"
+    # Hosts (and their subdomains) whose tunnels are never decrypted
+    passthrough_hosts = ()
+    # Seconds a blind tunnel may stay idle; None waits indefinitely
+    tunnel_idle_timeout = None
+    # Seconds a MITM tunnel waits on the origin for response data (long polls
+    # and event streams can be silent for minutes); None waits indefinitely
+    mitm_read_timeout = None
+    # Response bodies are relayed in chunks of this many bytes
+    stream_chunk_size = 64 * 1024
+    # Hold-back window: headers of a scanned text response wait until this many
+    # bytes pass the filter (or the body ends), so a match gets the block page
+    max_buffered_body = 1024 * 1024
+    # Decides per response how much of the body the content filter scans
+    inspection_policy = inspection_policy
+    # Compressed bodies stop being scanned once they decode past this size
+    max_decoded_body = 32 * 1024 * 1024
+    # Request bodies are sent upstream in chunks of this many bytes
+    upload_chunk_size = 64 * 1024
+    # Request bodies up to this size are read whole so a failed send can be retried
+    max_buffered_upload = 1024 * 1024
+    # Spool and scan request bodies with the content filter before forwarding
+    inspect_uploads = False
+    # Spooled request bodies move from memory to a temp file past this size
+    spool_memory_limit = 1024 * 1024
+
     def __init__(self, *args, content_filter=None, **kwargs):
         if content_filter:
             self.filter = content_filter
         else:
             self.filter = ContentFilter()
+        self._requests_served = 0
+        self._upload_pending = False
         super().__init__(*args, **kwargs)
 
+    def handle_one_request(self):
+        if self._requests_served:
+            # Only the wait for the next request line is bounded by the idle timeout
+            self.connection.settimeout(self.keep_alive_timeout)
+        super().handle_one_request()
+        self._requests_served += 1
+
+    def parse_request(self):
+        self.connection.settimeout(self.timeout)
+        if not super().parse_request():
+            return False
+
+        if self._requests_served + 1 >= self.max_keep_alive_requests:
+            self.close_connection = True
+        self._upload_pending = bool(
+            self.headers.get("Content-Length", "0") not in ("", "0")
+            or "chunked" in self.headers.get("Transfer-Encoding", "").lower()
+        )
+        return True
+
+    def handle_expect_100(self):
+        # The interim response must not pick up the final response's framing
+        self.send_response_only(100)
+        super().end_headers()
+        return True
+
+    def end_headers(self):
+        # An unread request body would be parsed as the next request
+        if self._upload_pending:
+            self.close_connection = True
+
+        if self.command != "CONNECT":
+            if self.close_connection:
+                if self.request_version == "HTTP/1.1":
+                    self.send_header("Connection", "close")
+            elif self.request_version != "HTTP/1.1":
+                self.send_header("Connection", "keep-alive")
+        super().end_headers()
+
     def do_CONNECT(self):
         """Handle CONNECT method for MITM HTTPS interception."""
+        # The socket belongs to the tunnel (or is refused) after this request
+        self.close_connection = True
         try:
             # Parse host and port
             host_port = self.path.split(":")
@@ -40,316 +164,335 @@ class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
                 f"[{datetime.datetime.now()}] CONNECT {host}:{port} from {self.client_address[0]}"
             )
 
-            try:
-                asyncio.run(
-                    crud.add_traffic_log("CONNECT", host, self.client_address[0])
-                )
-            except Exception as e:
-                logger.error(f"[TRAFFIC LOG ERROR] {e}")
+            traffic_log_writer.log("CONNECT", host, self.client_address[0])
 
             # Check if domain is blocked
             is_blocked, block_reason = self.is_domain_blocked(
                 host, self.client_address[0]
             )
             if is_blocked:
+                body = f"CONNECT blocked: {block_reason}".encode()
                 self.send_response(403)
                 self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
                 self.end_headers()
-                self.wfile.write(f"CONNECT blocked: {block_reason}".encode())
+                self.wfile.write(body)
                 return
 
-            # Create the folder to store certs if missing
-            os.makedirs("certs", exist_ok=True)
-            cert_file = f"certs/{host}.crt"
-            key_file = f"certs/{host}.key"
-
-            # Check if we already have a signed cert for this host
-            if not (os.path.exists(cert_file) and os.path.exists(key_file)):
-                from app.certificate import generate_signed_cert
-
-                generate_signed_cert(
-                    domain=host,
-                    ca_cert_file="proxy_ca.crt",
-                    ca_key_file="proxy_ca.key",
-                    out_cert_file=cert_file,
-                    out_key_file=key_file,
-                )
-                logger.info(f"Generated new MITM cert for {host}")
+            if not self._should_intercept(host):
+                self._passthrough(host, port)
+                return
+
+            # Per-host server context, built once and kept in an LRU
+            client_context = self.server_contexts.get(host)
 
             # Send 200 Connection established to browser
             self.send_response(200, "Connection established")
             self.end_headers()
 
-            client_socket = self.request
-
             # Wrap client socket with our fake cert -> intercept TLS
-            client_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            client_context.load_cert_chain(certfile=cert_file, keyfile=key_file)
-            client_ssl = client_context.wrap_socket(client_socket, server_side=True)
+            client_ssl = client_context.wrap_socket(self.request, server_side=True)
+            self.server_contexts.record_handshake(client_ssl)
 
             logger.info(f"TLS handshake completed with client for {host}")
 
             # Connect to target server with real TLS
             server_plain = socket.create_connection((host, port), timeout=30)
-            server_context = ssl.create_default_context()
-            server_ssl = server_context.wrap_socket(server_plain, server_hostname=host)
+            server_ssl = self.upstream_tls.wrap(server_plain, host, port)
 
             logger.info(f"TLS handshake completed with target {host}")
 
             # Start MITM proxying
-            self._mitm_tunnel_data(client_ssl, server_ssl, host=host)
+            self._mitm_tunnel_data(client_ssl, server_ssl, host=host, port=port)
 
         except Exception as e:
             logger.error(f"[CONNECT ERROR] {e}")
             try:
+                body = f"Connection failed: {str(e)}".encode()
                 self.send_response(502)
                 self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
                 self.end_headers()
-                self.wfile.write(f"Connection failed: {str(e)}".encode())
+                self.wfile.write(body)
             except:
                 pass
 
-    def _mitm_tunnel_data(self, client_ssl, server_ssl, host=None):
-        """Tunnel data between client (browser) and target server (with decryption)."""
+    def _mitm_tunnel_data(self, client_ssl, server_ssl, host=None, port=443):
+        """Relay decrypted traffic one request/response exchange at a time.
 
-        def forward(source, destination, direction, host=host):
-            try:
-                source.settimeout(None)
-                destination.settimeout(None)
-                buffer = b""
-                headers_parsed = False
-                content_length = None
-                is_chunked = False
-                body = b""
-                while True:
-                    data = source.recv(4096)
-                    if not data:
-                        break
-
-                    destination.sendall(data)
-
-                    if direction == "C->S":
-                        try:
-                            # Only do this if you want to see human-readable HTTP data
-                            decoded = data.decode("utf-8", errors="ignore")
-                            logger.info(
-                                f"[HTTPS REQUEST] {decoded[:300]}"
-                            )  # Log first 300 chars
-                        except Exception as e:
-                            logger.debug(f"[C->S decode error] {e}")
-                    elif direction == "S->C":
-                        buffer += data
-                        if not headers_parsed:
-                            if b"\r\n\r\n" in buffer:
-                                headers_parsed = True
-                                header_part, remaining = buffer.split(b"\r\n\r\n", 1)
-                                headers = header_part.decode("iso-8859-1")
-
-                                match = re.search(
-                                    r"Content-Length: (\d+)", headers, re.IGNORECASE
-                                )
-                                if match:
-                                    content_length = int(match.group(1))
-
-                                if "Transfer-Encoding: chunked" in headers:
-                                    is_chunked = True
-
-                                body += remaining
-
-                                if content_length is None and not is_chunked:
-                                    break
-                            else:
-                                body += data
-
-                            if content_length is not None:
-                                if len(body) >= content_length:
-                                    break
-                            elif is_chunked:
-                                # Crude end-of-chunk check (may need better parsing)
-                                if b"0\r\n\r\n" in body:
-                                    break
-
-            except Exception as e:
-                logger.info(f"[MITM {direction}] closed: {e}")
-            finally:
-                if direction == "S->C" and buffer:
-                    try:
-                        # Extract URL if possible, or pass "/" as dummy
-                        self.cache_https_response(buffer, host=host, url="/")
-                    except Exception as e:
-                        logger.warning(f"Failed to cache response: {e}")
-                try:
-                    source.close()
-                except:
-                    pass
+        Every request on the keep-alive tunnel goes through the same block
+        check, traffic log, cache and content filter as plain HTTP, on this
+        handler's thread.
+        """
+        authority = host if port == 443 else f"{host}:{port}"
+        client_ssl.settimeout(None)
+        # The 30 s timeout only bounds the connect and handshake
+        server_ssl.settimeout(self.mitm_read_timeout)
+        client = MessageReader(
+            client_ssl, HTTPParser(is_response=False), self.stream_chunk_size
+        )
+        server = MessageReader(
+            server_ssl, HTTPParser(is_response=True), self.stream_chunk_size
+        )
+        try:
+            while self._mitm_exchange(client_ssl, server_ssl, authority, client, server):
+                pass
+        except Exception as e:
+            logger.info(f"[MITM] tunnel to {authority} closed: {e}")
+        finally:
+            # Keep the freshest session (with its TLS 1.3 ticket) for the next tunnel
+            self.upstream_tls.remember(host, port, server_ssl)
+            for sock in (client_ssl, server_ssl):
                 try:
-                    destination.close()
+                    sock.close()
                 except:
                     pass
 
-        c2s = threading.Thread(
-            target=forward, args=(client_ssl, server_ssl, "C->S"), daemon=True
-        )
-        s2c = threading.Thread(
-            target=forward, args=(server_ssl, client_ssl, "S->C"), daemon=True
-        )
-
-        c2s.start()
-        s2c.start()
-
-        c2s.join()
-        s2c.join()
-
-    def cache_https_response(self, buffer: bytes, host: str, url: str):
-        cache_key = hashlib.sha256(f"{host}{url}".encode()).hexdigest()
-
-        cache_path = f"cache/{cache_key}.resp"
-        os.makedirs("cache", exist_ok=True)
-
-        with open(cache_path, "wb") as f:
-            f.write(buffer)
-
-        logger.info(f"[CACHE] Saved response to {cache_path}")
-
-    def _read_http_message(self, sock):
-        """
-        Read one full HTTP/1.1 message (request or response) from a socket,
-        handling both Content-Length and Transfer-Encoding: chunked.
-        """
+    def _mitm_exchange(self, client_ssl, server_ssl, authority, client, server):
+        """Handle one request inside a MITM tunnel; returns False once it should close."""
+        request = client.next_event()
+        if request is None:
+            return False
+        method, request_headers = request.method, request.headers
+        url = f"https://{authority}{request.target}"
+        logger.info(f"[HTTPS REQUEST] {method} {url}")
+
+        if "100-continue" in request_headers.get("Expect", "").lower():
+            # The body is read before the upstream answers, so confirm it ourselves
+            del request_headers["Expect"]
+            client_ssl.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        request_body = client.iter_body()
+        client_ip = self.client_address[0]
+        traffic_log_writer.log(method, url, client_ip)
+
+        # The Host header, not the CONNECT target, names the site being asked for
+        host = request_headers.get("Host", authority)
+        is_blocked, block_reason = self.is_domain_blocked(host, client_ip)
+        if is_blocked:
+            for _ in request_body:
+                pass
+            logger.warning(f"[MITM] blocked {url}: {block_reason}")
+            self._send_tunnel_html(client_ssl, 403, blocked_page(block_reason, url))
+            return request.keep_alive and self._resume_client(client)
 
-        # Step 1: Read headers
-        data = b""
-        while b"\r\n\r\n" not in data:
-            chunk = sock.recv(4096)
-            if not chunk:
-                return None
-            data += chunk
-
-        header_end = data.find(b"\r\n\r\n") + 4
-        headers = data[:header_end]
-        body = data[header_end:]
-
-        # Step 2: Parse headers
-        headers_text = headers.decode("iso-8859-1")
-        lines = headers_text.split("\r\n")
-        headers_dict = {}
-        for line in lines[1:]:
-            if ":" in line:
-                key, val = line.split(":", 1)
-                headers_dict[key.strip().lower()] = val.strip().lower()
-
-        # Step 3: Decide body transfer
-        if "content-length" in headers_dict:
-            length = int(headers_dict["content-length"])
-            while len(body) < length:
-                body += sock.recv(4096)
-            return headers + body
-
-        elif headers_dict.get("transfer-encoding") == "chunked":
-            # Handle chunked
-            body += self._read_chunked_body(sock, body)
-            return headers + body
+        # Before the cache lookup, so variants are stored and found under one key
+        self._limit_accept_encoding(request_headers)
+        if method == "GET":
+            cached = self.cache.get(url, dict(request_headers))
+            if cached is not None:
+                for _ in request_body:
+                    pass
+                self._send_tunnel_cached(client_ssl, cached)
+                return request.keep_alive and self._resume_client(client)
 
-        else:
-            # No body
-            return headers
-
-    def _read_chunked_body(self, sock, already_read=b""):
-        data = already_read
-        body = b""
-
-        def read_line():
-            nonlocal data
-            while b"\r\n" not in data:
-                more = sock.recv(4096)
-                if not more:
-                    return None
-                data += more
-            idx = data.find(b"\r\n")
-            line = data[:idx]
-            data = data[idx + 2 :]
-            return line
+        server.parser.expect(method)
+        server_ssl.sendall(serialize_head(request.start_line, request_headers))
+        self._relay_body(request_body, server_ssl, request.chunked)
 
         while True:
-            # Read chunk size line
-            size_line = read_line()
-            if size_line is None:
+            response = server.next_event()
+            if response is None:
+                raise ConnectionError("upstream closed before responding")
+            if response.status == 101:
+                # Protocol switch (e.g. WebSocket): relay the rest untouched
+                client_ssl.sendall(serialize_head(response.start_line, response.headers))
+                server.next_event()
+                client_ssl.sendall(server.take_upgraded())
+                server_ssl.sendall(client.parser.take_paused())
+                self._tunnel_data(client_ssl, server_ssl)
+                return False
+            if response.status >= 200:
                 break
+            client_ssl.sendall(serialize_head(response.start_line, response.headers))
+            server.next_event()
+
+        logger.info(f"[UPSTREAM] {response.status} {response.reason} for {url}")
+        response_data = {
+            "status_code": response.status,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+            "content_type": response.headers.get("Content-Type", ""),
+            "content_encoding": response.headers.get("Content-Encoding", ""),
+            "content_length": response.content_length,
+        }
+        body = server.iter_body()
+
+        prefix = b""
+        scanner = self._content_scanner(response_data, url)
+        if scanner is None:
+            body = self._count_skipped(body)
+        else:
+            # Held back while scanned, so an early match still gets the block page
+            body = self._scan_body(body, scanner)
             try:
-                chunk_size = int(size_line.strip(), 16)
-            except ValueError:
-                break
+                prefix, complete = self._read_body_prefix(body, self.max_buffered_body)
+            except ContentBlockedError as e:
+                logger.warning(f"[FILTER] blocked {url}: {e.reason}")
+                # The tunnel stays usable only if the whole body had arrived
+                keep_alive = (
+                    request.keep_alive
+                    and response.keep_alive
+                    and server.discard_message()
+                )
+                self._send_tunnel_html(
+                    client_ssl,
+                    403,
+                    blocked_page("Content filtered", url),
+                    close=not keep_alive,
+                )
+                return keep_alive and self._resume_client(client)
 
-            if chunk_size == 0:
-                # Read trailer and final CRLF
-                while True:
-                    trailer_line = read_line()
-                    if trailer_line in (b"", None):
-                        break
-                break
+        consumers = []
+        if method == "GET":
+            writer = self.cache.open_writer(url, response_data, dict(request_headers))
+            if writer is not None:
+                consumers.append(_CacheCollector(writer))
+            response.headers["X-Proxy-Cache"] = "MISS"
 
-            # Read chunk data
-            while len(data) < chunk_size + 2:
-                more = sock.recv(4096)
-                if not more:
-                    return body
-                data += more
+        client_ssl.sendall(serialize_head(response.start_line, response.headers))
+        try:
+            for consumer in consumers:
+                consumer.feed(prefix)
+            if prefix:
+                client_ssl.sendall(encode_chunk(prefix) if response.chunked else prefix)
+            self._relay_body(body, client_ssl, response.chunked, consumers)
+        except ContentBlockedError as e:
+            self._abort_consumers(consumers)
+            logger.warning(f"[FILTER] aborted streamed response for {url}: {e.reason}")
+            return False
+        except Exception:
+            self._abort_consumers(consumers)
+            raise
+        for consumer in consumers:
+            consumer.finish()
+
+        if method != "GET" and response.status < 400:
+            self.cache.invalidate(url)
+
+        return request.keep_alive and response.keep_alive and self._resume_client(client)
+
+    @staticmethod
+    def _read_body_prefix(chunks, limit):
+        """Buffer up to limit bytes of a body; returns ``(prefix, complete)``."""
+        prefix = bytearray()
+        for chunk in chunks:
+            prefix += chunk
+            if len(prefix) > limit:
+                return bytes(prefix), False
+        return bytes(prefix), True
+
+    @staticmethod
+    def _send_tunnel_html(sock, code, html, close=False):
+        """Answer a request inside a MITM tunnel with a proxy-generated page."""
+        body = html.encode("utf-8")
+        head = (
+            f"HTTP/1.1 {code} {HTTPStatus(code).phrase}\r\n"
+            "Content-Type: text/html\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            + ("Connection: close\r\n" if close else "")
+            + "\r\n"
+        )
+        sock.sendall(head.encode("iso-8859-1") + body)
+
+    @staticmethod
+    def _resume_client(client) -> bool:
+        """Pick up pipelined requests held back behind a refused upgrade."""
+        if client.parser.paused:
+            client.push(client.parser.resume())
+        return True
+
+    def _send_tunnel_cached(self, sock, cached_data):
+        """Answer a request inside a MITM tunnel from the cache."""
+        body_file = cached_data.get("body_file")
+        if body_file is not None:
+            content = b""
+            content_length = cached_data["content_length"]
+        else:
+            content = cached_data.get("content") or b""
+            content_length = len(content)
 
-            body += data[:chunk_size]
-            data = data[chunk_size + 2 :]  # skip CRLF
+        head = [f"HTTP/1.1 {cached_data['status_code']} {cached_data.get('reason', '')}"]
+        for key, value in cached_data.get("headers", {}).items():
+            if key.lower() not in ["connection", "transfer-encoding", "content-length"]:
+                head.append(f"{key}: {value}")
+        head.append(f"Content-Length: {content_length}")
+        head.append("X-Proxy-Cache: HIT")
 
-        return body
+        try:
+            sock.sendall(("\r\n".join(head) + "\r\n\r\n").encode("iso-8859-1"))
+            if body_file is not None:
+                self._send_body_file(sock, body_file, content_length)
+            else:
+                sock.sendall(content)
+        finally:
+            if body_file is not None:
+                body_file.close()
+
+    @staticmethod
+    def _relay_body(chunks, destination, chunked, consumers=()):
+        """Send body chunks on, re-applying chunked framing when the message used it."""
+        for chunk in chunks:
+            for consumer in consumers:
+                consumer.feed(chunk)
+            if chunked:
+                destination.sendall(encode_chunk(chunk))
+            else:
+                destination.sendall(chunk)
+        if chunked:
+            destination.sendall(LAST_CHUNK)
 
     def is_domain_blocked(self, domain: str, client_ip: Optional[str] = None):
         try:
             domain_only = domain.split(":")[0]
-            return asyncio.run(self.filter.is_domain_blocked(domain_only, client_ip))
+            rule_index = self.filter.rule_index
+            if rule_index is None:
+                rule_index = db_gateway.run(
+                    self.filter.refresh_rules(), timeout=DB_TIMEOUT
+                )
+            return rule_index.lookup(domain_only, client_ip)
         except Exception as e:
             logger.error(f"[BLOCK CHECK ERROR] {e}")
             return False, ""
 
     def _tunnel_data(self, client_socket, target_socket):
-        """Tunnel data between client and target server."""
-
-        def forward_data(source, destination, direction):
-            try:
-                source.settimeout(None)
-                destination.settimeout(None)
-                while True:
-                    data = source.recv(4096)
-                    if not data:
-                        break
-                    destination.send(data)
-            except Exception as e:
-                logger.info(f"[TUNNEL {direction}] Connection closed: {e}")
-            finally:
-                try:
-                    source.close()
-                except:
-                    pass
+        """Relay bytes blindly between client and target until both sides close."""
+        try:
+            totals = relay(
+                client_socket,
+                target_socket,
+                buffer_size=self.stream_chunk_size,
+                idle_timeout=self.tunnel_idle_timeout,
+            )
+            logger.info(
+                f"[TUNNEL] closed: {totals['sent']} bytes up, {totals['received']} bytes down"
+            )
+        finally:
+            for sock in (client_socket, target_socket):
                 try:
-                    destination.close()
+                    sock.close()
                 except:
                     pass
 
-        # Start forwarding in both directions
-        client_to_target = threading.Thread(
-            target=forward_data,
-            args=(client_socket, target_socket, "C->T"),
-            daemon=True,
-        )
-        target_to_client = threading.Thread(
-            target=forward_data,
-            args=(target_socket, client_socket, "T->C"),
-            daemon=True,
-        )
-
-        client_to_target.start()
-        target_to_client.start()
-
-        # Wait for connections to close
-        client_to_target.join()
-        target_to_client.join()
+    def _should_intercept(self, host: str) -> bool:
+        """Decide whether a CONNECT tunnel is decrypted or relayed blindly."""
+        if host_matches(host, self.passthrough_hosts):
+            return False
+        if self.mitm_mode == "never":
+            return False
+        if self.mitm_mode == "auto":
+            # Only content rules need to see inside a tunnel; domain rules were
+            # already applied to the CONNECT itself
+            return bool(self.filter.blocked_keywords)
+        return True
+
+    def _passthrough(self, host: str, port: int):
+        """Answer the CONNECT and splice the client to the origin without decrypting."""
+        target_socket = socket.create_connection((host, port), timeout=30)
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        logger.info(f"[PASSTHROUGH] {host}:{port}")
+        self._tunnel_data(self.request, target_socket)
 
     def do_GET(self):
         """Handle GET requests."""
@@ -403,214 +546,466 @@ class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
                 return
 
         # Forward request
+        self._response_started = False
         try:
             response_data = self._forward_http_request(method, url)
 
-            logger.info(response_data)
-
             if response_data:
-                # Filter content
-                if self._should_filter_content(response_data):
-                    self._send_blocked_response("Content filtered")
-                    return
-
-                # Cache successful GET responses
-                if method == "GET" and response_data.get("status_code") == 200:
-                    self.cache.set(url, response_data, dict(self.headers))
-
-                # Send response
-                self._send_response(response_data)
+                logger.info(
+                    f"[UPSTREAM] {response_data['status_code']} "
+                    f"{response_data['reason']} for {url}"
+                )
+                # Unsafe methods make stored copies of the URL stale
+                if method != "GET" and response_data["status_code"] < 400:
+                    self.cache.invalidate(url)
+                self._relay_response(method, url, response_data)
             else:
                 self._send_error_response(502, "Bad Gateway")
 
+        except ContentBlockedError as e:
+            logger.warning(f"[FILTER] blocked upload to {url}: {e.reason}")
+            self._send_blocked_response(e.reason)
+
+        except ProtocolError as e:
+            logger.warning(f"[HTTP] malformed request body for {url}: {e}")
+            self._send_error_response(400, "Bad Request")
+
         except Exception as e:
             logger.error(f"[HTTP ERROR] {e}")
-            self._send_error_response(500, f"Proxy Error: {str(e)}")
+            if self._response_started:
+                # Headers are already out; all we can do is cut the connection
+                self.close_connection = True
+            else:
+                self._send_error_response(500, f"Proxy Error: {str(e)}")
 
     def _forward_http_request(self, method, url):
-        """Forward HTTP request to target server."""
-        parsed_url = urllib.parse.urlparse(url)
-
-        # Create SSL context that doesn't verify certificates
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE
-
-        # Determine connection type
-        if parsed_url.scheme == "https":
-            conn = HTTPSConnection(parsed_url.netloc, timeout=30, context=ssl_context)
-        else:
-            conn = HTTPConnection(parsed_url.netloc, timeout=30)
+        """Forward HTTP request to target server.
 
+        Returns the response metadata with the body still unread; the caller
+        must consume ``response`` and then call ``release``.
+        """
+        parsed_url = urllib.parse.urlparse(url)
+        scheme, netloc = parsed_url.scheme, parsed_url.netloc
+
+        # Prepare request path
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path += f"?{parsed_url.query}"
+
+        # Prepare headers
+        headers = dict(self.headers)
+        headers.pop("Connection", None)
+        headers.pop("Proxy-Connection", None)
+        headers.pop("Keep-Alive", None)
+        headers.pop("Transfer-Encoding", None)
+        headers.pop("Proxy-Authorization", None)
+        # Body framing is re-derived by _request_body
+        headers.pop("Content-Length", None)
+        self._limit_accept_encoding(headers)
+
+        body, replayable = self._request_body(headers)
+        chunked_upload = "Transfer-Encoding" in headers
+
+        conn = None
         try:
-            # Prepare request path
-            path = parsed_url.path or "/"
-            if parsed_url.query:
-                path += f"?{parsed_url.query}"
-
-            # Prepare headers
-            headers = dict(self.headers)
-            headers.pop("Connection", None)
-            headers.pop("Proxy-Connection", None)
-            headers.pop("Transfer-Encoding", None)
-            headers.pop("Proxy-Authorization", None)
-
-            # Read request body
-            body = None
-            if method in ["POST", "PUT"] and "Content-Length" in headers:
-                content_length = int(headers["Content-Length"])
-                body = self.rfile.read(content_length)
-
-            # Make request
-            conn.request(method, path, body, headers)
-            response = conn.getresponse()
-
-            # Read response
-            response_content = response.read()
-            response_headers = dict(response.getheaders())
-
-            return {
-                "status_code": response.status,
-                "reason": response.reason,
-                "headers": response_headers,
-                "content": response_content,
-                "content_type": response_headers.get("Content-Type", ""),
-            }
+            conn, reused = self.upstream_pool.acquire(scheme, netloc)
+            try:
+                conn.request(
+                    method, path, body, headers, encode_chunked=chunked_upload
+                )
+                response = conn.getresponse()
+            except (RemoteDisconnected, ConnectionError) as e:
+                if not (reused and replayable):
+                    raise
+                # The origin dropped an idle keep-alive connection; retry once
+                logger.debug(f"[FORWARD] stale pooled connection to {netloc}: {e}")
+                self.upstream_pool.release(scheme, netloc, conn, reusable=False)
+                conn = None
+                if hasattr(body, "seek"):
+                    body.seek(0)
+                conn, _ = self.upstream_pool.acquire(scheme, netloc, fresh=True)
+                conn.request(
+                    method, path, body, headers, encode_chunked=chunked_upload
+                )
+                response = conn.getresponse()
 
         except Exception as e:
             logger.error(f"[FORWARD ERROR] {e}")
+            if conn is not None:
+                self.upstream_pool.release(scheme, netloc, conn, reusable=False)
             return None
 
         finally:
-            conn.close()
+            if hasattr(body, "close"):
+                body.close()
+
+        def release(reusable):
+            # Only a fully consumed response leaves the connection ready for reuse
+            reusable = reusable and response.isclosed()
+            self.upstream_pool.release(scheme, netloc, conn, reusable)
+
+        response_headers = dict(response.getheaders())
+        return {
+            "status_code": response.status,
+            "reason": response.reason,
+            "headers": response_headers,
+            "content_type": response_headers.get("Content-Type", ""),
+            "content_encoding": response.getheader("Content-Encoding", ""),
+            "content_length": response.length,
+            "response": response,
+            "release": release,
+        }
+
+    def _request_body(self, headers):
+        """Prepare the client's request body for http.client.
+
+        Returns ``(body, replayable)``. Small bodies are read into memory,
+        larger ones are streamed from the client in bounded chunks, and when
+        uploads are inspected the body is spooled (to disk past
+        spool_memory_limit) and scanned before anything is sent. Sets the
+        framing header on ``headers`` to match.
+        """
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            length = None
+        else:
+            length = parse_content_length(self.headers)
+            if length is None:
+                return None, True
+        chunks = self._iter_upload()
+
+        if self.inspect_uploads:
+            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_memory_limit)
+            scanner = StreamingContentScanner(self.filter)
+            try:
+                for chunk in chunks:
+                    spool.write(scanner.feed(chunk))
+                spool.write(scanner.finish())
+            except BaseException:
+                spool.close()
+                raise
+            headers["Content-Length"] = str(spool.tell())
+            spool.seek(0)
+            return spool, True
+
+        if length is not None and length <= self.max_buffered_upload:
+            headers["Content-Length"] = str(length)
+            return b"".join(chunks), True
+
+        if length is not None:
+            headers["Content-Length"] = str(length)
+        else:
+            # http.client re-chunks the iterable on the way out
+            headers["Transfer-Encoding"] = "chunked"
+        return chunks, False
+
+    def _iter_upload(self):
+        """Yield the request body's payload as it arrives from the client."""
+        parser = HTTPParser(is_response=False)
+        # The head was already read by BaseHTTPRequestHandler; replay it for the framing
+        events = parser.feed(serialize_head(self.requestline, self.headers))
+        if not isinstance(events[-1], EndOfMessage):
+            yield from iter_file_body(self.rfile, parser, self.upload_chunk_size)
+        self._upload_pending = False
+
+    def _relay_response(self, method, url, response_data):
+        """Send an upstream response to the client, buffering only when needed."""
+        response = response_data["response"]
+        reusable = False
+        try:
+            chunks = self._iter_response(response)
+            prefix = b""
+            scanner = self._content_scanner(response_data, url)
+            if scanner is None:
+                chunks = self._count_skipped(chunks)
+            else:
+                # Text is held back while it is scanned, so a match in the first
+                # max_buffered_body bytes can still be answered with the block page
+                chunks = self._scan_body(chunks, scanner)
+                try:
+                    prefix, complete = self._read_body_prefix(
+                        chunks, self.max_buffered_body
+                    )
+                except ContentBlockedError as e:
+                    logger.warning(f"[FILTER] blocked {url}: {e.reason}")
+                    self._send_blocked_response("Content filtered")
+                    return
 
-    def _should_filter_content(self, response_data):
-        """Check if content should be filtered."""
-        content_type = response_data.get("content_type", "")
+                if complete:
+                    reusable = not response.will_close
+                    response_data["content"] = prefix
 
-        # Check content for blocked keywords (only for text content)
-        if content_type.startswith("text/"):
-            try:
-                content = response_data.get("content", b"").decode(
-                    "utf-8", errors="ignore"
-                )
-                is_blocked, _ = self.filter.is_content_blocked(content)
-                return is_blocked
-            except:
-                pass
+                    # Cache GET responses the origin allows us to store
+                    if method == "GET":
+                        self.cache.set(url, response_data, dict(self.headers))
+
+                    self._send_response(response_data)
+                    return
+
+            consumers = []
+            if method == "GET":
+                writer = self.cache.open_writer(url, response_data, dict(self.headers))
+                if writer is not None:
+                    consumers.append(_CacheCollector(writer))
+
+            reusable = self._stream_response(
+                method, response_data, chunks, consumers, prefix
+            )
+        finally:
+            response_data["release"](reusable)
+
+    def _iter_response(self, response):
+        """Yield an upstream body as views into one reused read buffer."""
+        buffer = bytearray(self.stream_chunk_size)
+        view = memoryview(buffer)
+        while True:
+            count = response.readinto(buffer)
+            if not count:
+                return
+            yield view[:count]
+
+    def _stream_response(self, method, response_data, chunks, consumers, prefix=b""):
+        """Relay headers at once and pipe the body in bounded chunks.
+
+        Returns True when the upstream body was read to the end.
+        """
+        response = response_data["response"]
+
+        has_body = method != "HEAD" and response.status not in (204, 304)
+        chunked = has_body and response.getheader("Content-Length") is None
+        # Re-chunk only for clients that can parse it; others get close-delimited bodies
+        rechunk = (
+            chunked
+            and self.request_version == "HTTP/1.1"
+            and self.protocol_version == "HTTP/1.1"
+        )
+
+        self.send_response(response.status, response.reason)
+        for key, value in response.getheaders():
+            if key.lower() not in ["connection", "keep-alive", "transfer-encoding"]:
+                self.send_header(key, value)
+        if rechunk:
+            self.send_header("Transfer-Encoding", "chunked")
+        elif chunked:
+            self.close_connection = True
+        if method == "GET":
+            self.send_header("X-Proxy-Cache", "MISS")
+        self.end_headers()
+        self._response_started = True
+
+        def write(data):
+            if not data:
+                return
+            for consumer in consumers:
+                consumer.feed(data)
+            if rechunk:
+                self.wfile.write(b"%x\r\n" % len(data))
+                self.wfile.write(data)
+                self.wfile.write(b"\r\n")
+            else:
+                self.wfile.write(data)
+
+        if not has_body:
+            # Lets http.client mark the bodiless response as complete
+            response.read()
+
+        try:
+            write(prefix)
+            for chunk in chunks:
+                write(chunk)
+
+            for consumer in consumers:
+                consumer.finish()
+        except ContentBlockedError as e:
+            self._abort_consumers(consumers)
+            logger.warning(f"[FILTER] aborted streamed response: {e.reason}")
+            self.close_connection = True
+            return False
+        except Exception:
+            self._abort_consumers(consumers)
+            raise
+
+        if rechunk:
+            self.wfile.write(b"0\r\n\r\n")
+        return not response.will_close
+
+    @staticmethod
+    def _abort_consumers(consumers):
+        for consumer in consumers:
+            consumer.abort()
+
+    def _limit_accept_encoding(self, headers):
+        """Only offer the origin codings the content filter can decode."""
+        accept_encoding = headers.get("Accept-Encoding")
+        if accept_encoding is None or not len(self.filter.keyword_matcher):
+            return
+        del headers["Accept-Encoding"]
+        headers["Accept-Encoding"] = inspectable_encodings(accept_encoding)
+
+    def _content_scanner(self, response_data, url) -> Optional[StreamingContentScanner]:
+        """Return a scanner for the part of a response the policy inspects, if any."""
+        if not len(self.filter.keyword_matcher):
+            return None
+        rule = self.inspection_policy.decide(
+            urllib.parse.urlsplit(url).hostname or "",
+            response_data.get("content_type", ""),
+            response_data.get("content_length"),
+        )
+        if rule.action == SKIP:
+            return None
+        # Compressed bodies are decoded for the matcher; the client gets them as sent
+        scanner = StreamingContentScanner(
+            self.filter,
+            response_data.get("content_encoding", ""),
+            max_decoded=self.max_decoded_body,
+            scan_limit=rule.scan_limit,
+            sample_interval=rule.sample_interval,
+        )
+        return scanner if scanner.inspecting else None
 
-        return False
+    def _scan_body(self, chunks, scanner):
+        """Pass body chunks through a scanner, yielding only the bytes it releases."""
+        try:
+            for chunk in chunks:
+                data = scanner.feed(chunk)
+                if data:
+                    yield data
+            data = scanner.finish()
+            if data:
+                yield data
+        finally:
+            self.inspection_policy.record(scanner.scanned, scanner.skipped)
+
+    def _count_skipped(self, chunks):
+        """Pass a body the filter does not inspect through, counting its bytes."""
+        skipped = 0
+        try:
+            for chunk in chunks:
+                skipped += len(chunk)
+                yield chunk
+        finally:
+            self.inspection_policy.record(0, skipped)
 
     def _send_response(self, response_data):
         """Send response to client."""
-        self.send_response(
-            response_data["status_code"], response_data.get("reason", "")
-        )
+        content = response_data.get("content", b"")
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        status = response_data["status_code"]
+        self.send_response(status, response_data.get("reason", ""))
 
         # Send headers
+        stored_length = None
         for key, value in response_data.get("headers", {}).items():
-            if key.lower() not in ["connection", "transfer-encoding"]:
+            if key.lower() == "content-length":
+                stored_length = value
+            elif key.lower() not in ["connection", "transfer-encoding"]:
                 self.send_header(key, value)
+        if status == 304 or self.command == "HEAD":
+            # No body follows; a Content-Length here is the representation's length
+            if stored_length is not None:
+                self.send_header("Content-Length", stored_length)
+        elif status != 204 and status >= 200:
+            self.send_header("Content-Length", str(len(content)))
+        if self.command == "GET":
+            self.send_header("X-Proxy-Cache", "MISS")
 
         self.end_headers()
 
         # Send content
-        content = response_data.get("content", b"")
-        if isinstance(content, str):
-            content = content.encode("utf-8")
-
         self.wfile.write(content)
 
     def _send_cached_response(self, cached_data):
         """Send cached response to client."""
-        self.send_response(cached_data["status_code"])
+        body_file = cached_data.get("body_file")
+        if body_file is not None:
+            content = b""
+            content_length = cached_data["content_length"]
+        else:
+            content = cached_data.get("content", "")
+            if isinstance(content, str):
+                content = content.encode("utf-8")
+            content_length = len(content)
 
-        for key, value in cached_data.get("headers", {}).items():
-            if key.lower() not in ["connection", "transfer-encoding"]:
-                self.send_header(key, value)
+        try:
+            self.send_response(cached_data["status_code"])
 
-        self.send_header("X-Proxy-Cache", "HIT")
-        self.end_headers()
+            for key, value in cached_data.get("headers", {}).items():
+                if key.lower() not in ["connection", "transfer-encoding", "content-length"]:
+                    self.send_header(key, value)
+            self.send_header("Content-Length", str(content_length))
 
-        content = cached_data.get("content", "")
-        if isinstance(content, str):
-            content = content.encode("utf-8")
+            self.send_header("X-Proxy-Cache", "HIT")
+            self.end_headers()
 
-        self.wfile.write(content)
+            if body_file is None:
+                self.wfile.write(content)
+            elif self.command != "HEAD":
+                self._send_body_file(self.connection, body_file, content_length)
+        finally:
+            if body_file is not None:
+                body_file.close()
 
-    def _send_blocked_response(self, reason):
-        """Send blocked response."""
-        self.send_response(403)
-        self.send_header("Content-Type", "text/html")
-        self.end_headers()
+    def _send_body_file(self, sock, body_file, size):
+        """Send a cached body file without copying it through Python buffers.
 
-        blocked_html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Content Blocked</title>
-        </head>
-        <body>
-            <h1>Access Blocked</h1>
-            <p><strong>Reason:</strong> {reason}</p>
-            <p><strong>URL:</strong> {self.path}</p>
-            <p><strong>Time:</strong> {datetime.datetime.now()}</p>
-        </body>
-        </html>
+        Plain sockets use ``sendfile``; TLS sockets cannot, so the file is
+        mmapped and written in slices straight from the page cache.
         """
+        if size == 0:
+            return
+        if not isinstance(sock, ssl.SSLSocket):
+            sock.sendfile(body_file, 0, size)
+            return
 
-        self.wfile.write(blocked_html.encode("utf-8"))
+        with mmap.mmap(body_file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for start in range(0, size, self.stream_chunk_size):
+                    sock.sendall(view[start : start + self.stream_chunk_size])
+            finally:
+                view.release()
 
-    def _send_error_response(self, code, message):
-        """Send error response."""
+    def _send_html(self, code, html):
+        body = html.encode("utf-8")
         self.send_response(code)
         self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
 
-        error_html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Proxy Error</title>
-        </head>
-        <body>
-            <h1>Proxy Error {code}</h1>
-            <p>{message}</p>
-            <p>URL: {self.path}</p>
-        </body>
-        </html>
-        """
+    def _send_blocked_response(self, reason):
+        """Send blocked response."""
+        self._send_html(403, blocked_page(reason, self.path))
 
-        self.wfile.write(error_html.encode("utf-8"))
+    def _send_error_response(self, code, message):
+        """Send error response."""
+        self._send_html(code, error_page(code, message, self.path))
 
     def _handle_admin_request(self):
         """Handle proxy admin interface."""
-        self.send_response(200)
-        self.send_header("Content-Type", "text/html")
-        self.end_headers()
-
-        admin_html = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Proxy Server Admin</title>
-        </head>
-        <body>
-            <h1>Proxy Server Status</h1>
-            <p><strong>Status:</strong> Running</p>
-            <p><strong>Active Threads:</strong> {threading.active_count()}</p>
-            <p><strong>Cache Directory:</strong> {self.cache.cache_dir}</p>
-            <p><strong>Time:</strong> {datetime.datetime.now()}</p>
-            
-            <h3>Blocked Domains</h3>
-            <ul>
-                {''.join(f'<li>{domain}</li>' for domain in self.filter.blocked_domains)}
-            </ul>
-        </body>
-        </html>
-        """
-
-        self.wfile.write(admin_html.encode("utf-8"))
+        tls_stats = {
+            **{f"client {k}": v for k, v in self.server_contexts.stats().items()},
+            **{f"upstream {k}": v for k, v in self.upstream_tls.stats().items()},
+        }
+        rule_index = self.filter.rule_index
+        rules = rule_index.rules if rule_index is not None else []
+
+        admin_html = admin_page(
+            {
+                "Status": "Running",
+                "Active Threads": threading.active_count(),
+                "Cache Directory": self.cache.cache_dir,
+                "Time": datetime.datetime.now(),
+            },
+            {
+                "Cache": self.cache.stats(),
+                "TLS": tls_stats,
+                "Content Inspection": self.inspection_policy.stats(),
+            },
+            [rule.pattern for rule in rules],
+        )
+        self._send_html(200, admin_html)
 
     def log_message(self, format, *args):
         """Suppress default logging."""
@@ -0,0 +1,538 @@
+import re
+import time
+from collections import deque
+from dataclasses import dataclass
+from email.parser import BytesParser
+from http.client import HTTPMessage
+from typing import Deque, Optional, Tuple
+
+MAX_HEADER_SIZE = 65536
+MAX_LINE_SIZE = 8192
+
+# chunk-size is 1*HEXDIG and Content-Length 1*DIGIT; int() alone also takes
+# signs, whitespace, underscores and 0x prefixes
+_CHUNK_SIZE_RE = re.compile(rb"[0-9A-Fa-f]+")
+_CONTENT_LENGTH_RE = re.compile(r"[0-9]+")
+
+# Parser states
+_HEAD = "head"
+_BODY_LENGTH = "body-length"
+_BODY_EOF = "body-eof"
+_CHUNK_SIZE = "chunk-size"
+_CHUNK_DATA = "chunk-data"
+_CHUNK_CRLF = "chunk-crlf"
+_TRAILERS = "trailers"
+_PAUSED = "paused"
+_UPGRADED = "upgraded"
+
+
+class ProtocolError(Exception):
+    """Raised on malformed or truncated HTTP/1.x framing."""
+
+
+@dataclass
+class Head:
+    """Start line and headers of one request or response."""
+
+    start_line: str
+    headers: HTTPMessage
+    version: str
+    method: Optional[str] = None
+    target: Optional[str] = None
+    status: Optional[int] = None
+    reason: str = ""
+    # "none", "length", "chunked" or "eof" (close-delimited)
+    framing: str = "none"
+    content_length: Optional[int] = None
+
+    @property
+    def chunked(self) -> bool:
+        return self.framing == "chunked"
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("Connection", "").lower()
+        if self.framing == "eof" or "close" in connection:
+            return False
+        return self.version == "HTTP/1.1" or "keep-alive" in connection
+
+
+@dataclass
+class Body:
+    """A piece of decoded payload.
+
+    ``data`` is a memoryview into the buffer passed to ``feed``; it is only
+    valid until that buffer is reused.
+    """
+
+    data: memoryview
+
+
+@dataclass
+class EndOfMessage:
+    pass
+
+
+@dataclass
+class Upgrade:
+    """The connection switched protocols (101); ``data`` holds bytes after the head."""
+
+    data: bytes
+
+
+def parse_head(head: bytes) -> Tuple[str, HTTPMessage]:
+    """Split a raw HTTP head into its start line and parsed headers."""
+    start_line, _, header_block = head.partition(b"\r\n")
+    headers = BytesParser(_class=HTTPMessage).parsebytes(header_block)
+    return start_line.decode("iso-8859-1").strip(), headers
+
+
+def parse_content_length(headers) -> Optional[int]:
+    """Return the Content-Length, or None if absent.
+
+    Repeated headers (or a comma-separated list) are accepted only when every
+    value is the same.
+    """
+    fields = headers.get_all("Content-Length")
+    if not fields:
+        return None
+    values = {value.strip() for field in fields for value in field.split(",")}
+    if len(values) != 1:
+        raise ProtocolError(f"conflicting Content-Length: {fields!r}")
+    value = values.pop()
+    if not _CONTENT_LENGTH_RE.fullmatch(value):
+        raise ProtocolError(f"bad Content-Length: {value!r}")
+    return int(value)
+
+
+def serialize_head(start_line: str, headers) -> bytes:
+    lines = [start_line]
+    lines.extend(f"{key}: {value}" for key, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+
+def encode_chunk(data) -> bytes:
+    return b"%x\r\n" % len(data) + bytes(data) + b"\r\n"
+
+
+LAST_CHUNK = b"0\r\n\r\n"
+
+
+class HTTPParser:
+    """Incremental HTTP/1.1 parser for one direction of a connection.
+
+    ``feed`` takes whatever bytes arrived and returns the events they
+    complete: a ``Head``, any number of ``Body`` pieces, then
+    ``EndOfMessage``. Body pieces are memoryview slices of the fed buffer,
+    so payload bytes are never copied; only partial heads and chunk-size
+    lines are held back between calls. Several pipelined messages in one
+    buffer are all parsed. Response framing depends on the request method,
+    so a response parser is told each method with ``expect``.
+    """
+
+    def __init__(self, is_response: bool, max_header_size: int = MAX_HEADER_SIZE):
+        self.is_response = is_response
+        self.max_header_size = max_header_size
+        self._state = _HEAD
+        # Bytes of an incomplete head or line carried over to the next feed
+        self._pending = bytearray()
+        self._scan_from = 0
+        self._remaining = 0
+        self._methods: Deque[str] = deque()
+        # Set by a request asking to switch protocols; parsing pauses after it
+        self._upgrade_requested = False
+
+    @property
+    def idle(self) -> bool:
+        """True between messages, with nothing buffered."""
+        return self._state == _HEAD and not self._pending
+
+    @property
+    def paused(self) -> bool:
+        """True after an upgrade request, until ``take_paused`` or ``resume``."""
+        return self._state == _PAUSED
+
+    @property
+    def wanted(self) -> Optional[int]:
+        """Bytes the current body can still take in one feed.
+
+        None when a line (chunk size or trailer) comes next. Lets a reader
+        that shares its stream with other code stop exactly at the end of
+        the message.
+        """
+        if self._state in (_BODY_LENGTH, _CHUNK_DATA, _CHUNK_CRLF):
+            return self._remaining
+        return None
+
+    def expect(self, method: str):
+        """Register the method of a request whose response this parser will see."""
+        self._methods.append(method)
+
+    def feed(self, data, length: Optional[int] = None) -> list:
+        """Parse ``data[:length]`` and return the events it completes."""
+        if length is None:
+            length = len(data)
+        events: list = []
+        view = memoryview(data)
+        pos = 0
+        while pos < length:
+            state = self._state
+            if state == _HEAD:
+                pos = self._parse_head(data, view, pos, length, events)
+            elif state in (_BODY_LENGTH, _CHUNK_DATA):
+                take = min(self._remaining, length - pos)
+                events.append(Body(view[pos : pos + take]))
+                pos += take
+                self._remaining -= take
+                if not self._remaining:
+                    if state == _BODY_LENGTH:
+                        self._end_message(events)
+                    else:
+                        self._state = _CHUNK_CRLF
+                        self._remaining = 2
+            elif state == _CHUNK_CRLF:
+                take = min(self._remaining, length - pos)
+                pos += take
+                self._remaining -= take
+                if not self._remaining:
+                    self._state = _CHUNK_SIZE
+            elif state == _CHUNK_SIZE:
+                line, pos = self._read_line(data, pos, length)
+                if line is None:
+                    break
+                size = line.split(b";", 1)[0].rstrip(b" \t")
+                if not _CHUNK_SIZE_RE.fullmatch(size):
+                    raise ProtocolError(f"bad chunk size line: {line[:40]!r}")
+                size = int(size, 16)
+                if size:
+                    self._state = _CHUNK_DATA
+                    self._remaining = size
+                else:
+                    self._state = _TRAILERS
+            elif state == _TRAILERS:
+                line, pos = self._read_line(data, pos, length)
+                if line is None:
+                    break
+                if not line:
+                    self._end_message(events)
+            elif state == _BODY_EOF:
+                events.append(Body(view[pos:length]))
+                pos = length
+            elif state == _PAUSED:
+                # Held until the peer accepts or refuses the upgrade
+                self._pending += view[pos:length]
+                pos = length
+            else:  # _UPGRADED
+                events.append(Upgrade(bytes(view[pos:length])))
+                pos = length
+        return events
+
+    def feed_eof(self) -> list:
+        """Signal that the peer closed; ends a close-delimited body."""
+        if self._state == _BODY_EOF:
+            events: list = []
+            self._end_message(events)
+            return events
+        if self._state == _HEAD and not self._pending.strip():
+            return []
+        if self._state in (_PAUSED, _UPGRADED):
+            return []
+        raise ProtocolError("connection closed mid-message")
+
+    def take_paused(self) -> bytes:
+        """Return bytes held after an upgrade request once the upgrade is accepted."""
+        data = bytes(self._pending)
+        self._pending.clear()
+        self._state = _UPGRADED
+        return data
+
+    def resume(self) -> list:
+        """Continue parsing after an upgrade request was refused."""
+        data = bytes(self._pending)
+        self._pending.clear()
+        self._scan_from = 0
+        self._state = _HEAD
+        return self.feed(data) if data else []
+
+    def _read_line(self, data, pos: int, length: int):
+        """Return ``(line, new_pos)``, or ``(None, length)`` if the line is incomplete."""
+        end = data.find(b"\n", pos, length)
+        if end == -1:
+            self._pending += data[pos:length]
+            if len(self._pending) > MAX_LINE_SIZE:
+                raise ProtocolError("line too long")
+            return None, length
+        if self._pending:
+            self._pending += data[pos : end + 1]
+            line = bytes(self._pending)
+            self._pending.clear()
+        else:
+            line = bytes(data[pos : end + 1])
+        return line.rstrip(b"\r\n"), end + 1
+
+    def _parse_head(self, data, view, pos: int, length: int, events: list) -> int:
+        if not self._pending:
+            # Tolerate stray CRLFs between messages
+            while pos < length and data[pos] in (13, 10):
+                pos += 1
+            if pos == length:
+                return pos
+
+        start = len(self._pending)
+        self._pending += view[pos:length]
+        end = self._pending.find(b"\r\n\r\n", self._scan_from)
+        if end == -1:
+            if len(self._pending) > self.max_header_size:
+                raise ProtocolError("HTTP head too large")
+            # Resume the search where a split terminator could begin
+            self._scan_from = max(0, len(self._pending) - 3)
+            return length
+
+        head = bytes(self._pending[: end + 4])
+        consumed = end + 4 - start
+        self._pending.clear()
+        self._scan_from = 0
+        self._start_message(head, events)
+        return pos + consumed
+
+    def _start_message(self, raw_head: bytes, events: list):
+        start_line, headers = parse_head(raw_head)
+        parts = start_line.split(" ", 2)
+        if len(parts) < 2:
+            raise ProtocolError(f"bad start line: {start_line[:80]!r}")
+
+        if self.is_response:
+            version, status = parts[0], parts[1]
+            try:
+                status_code = int(status)
+            except ValueError:
+                raise ProtocolError(f"bad status line: {start_line[:80]!r}")
+            head = Head(
+                start_line,
+                headers,
+                version,
+                status=status_code,
+                reason=parts[2] if len(parts) > 2 else "",
+            )
+        else:
+            if len(parts) < 3:
+                raise ProtocolError(f"bad request line: {start_line[:80]!r}")
+            head = Head(start_line, headers, parts[2], method=parts[0], target=parts[1])
+
+        transfer_encoding = headers.get("Transfer-Encoding", "").lower()
+        content_length = parse_content_length(headers)
+        if self._is_bodiless(head):
+            head.framing = "none"
+        elif "chunked" in transfer_encoding:
+            head.framing = "chunked"
+        elif content_length is not None:
+            head.content_length = content_length
+            head.framing = "length" if content_length else "none"
+        elif self.is_response:
+            head.framing = "eof"
+        events.append(head)
+
+        if self.is_response and head.status == 101:
+            self._state = _UPGRADED
+            events.append(EndOfMessage())
+            return
+        if self.is_response and 100 <= head.status < 200:
+            # Interim response; the final one for this request follows
+            events.append(EndOfMessage())
+            return
+
+        if not self.is_response:
+            connection = headers.get("Connection", "").lower()
+            # A CONNECT turns the rest of the stream into a tunnel, like an upgrade
+            self._upgrade_requested = head.method == "CONNECT" or (
+                "upgrade" in connection and "Upgrade" in headers
+            )
+
+        if head.framing == "length":
+            self._state = _BODY_LENGTH
+            self._remaining = head.content_length
+        elif head.framing == "chunked":
+            self._state = _CHUNK_SIZE
+        elif head.framing == "eof":
+            self._state = _BODY_EOF
+        else:
+            self._end_message(events)
+
+    def _is_bodiless(self, head: Head) -> bool:
+        if not self.is_response:
+            return False
+        if 100 <= head.status < 200 or head.status in (204, 304):
+            return True
+        method = self._methods[0] if self._methods else "GET"
+        return method == "HEAD"
+
+    def _end_message(self, events: list):
+        events.append(EndOfMessage())
+        self._remaining = 0
+        if self.is_response:
+            if self._methods:
+                self._methods.popleft()
+            self._state = _HEAD
+        elif self._upgrade_requested:
+            self._upgrade_requested = False
+            self._state = _PAUSED
+        else:
+            self._state = _HEAD
+
+
+class _EventQueue:
+    """Parser events received but not yet consumed, shared by the readers below."""
+
+    def __init__(self, parser: HTTPParser):
+        self.parser = parser
+        self._events: Deque = deque()
+        self.eof = False
+
+    def push(self, events: list):
+        self._events.extend(events)
+
+    def _received(self, data, length: int):
+        if not length:
+            self.eof = True
+            self._events.extend(self.parser.feed_eof())
+        else:
+            self._events.extend(self.parser.feed(data, length))
+
+    def take_upgraded(self) -> bytes:
+        """Return the already received bytes that followed a 101 response."""
+        data = b"".join(
+            event.data for event in self._events if isinstance(event, Upgrade)
+        )
+        self._events.clear()
+        return data
+
+    def discard_message(self) -> bool:
+        """Drop the rest of the current message if it has been fully received.
+
+        Returns False when more of it would still have to be read.
+        """
+        if not self.parser.idle:
+            return False
+        while self._events:
+            if isinstance(self._events.popleft(), EndOfMessage):
+                break
+        return True
+
+
+class MessageReader(_EventQueue):
+    """Pulls parser events from a blocking socket through a preallocated buffer.
+
+    ``Body`` views point into the shared buffer and are only valid until the
+    next call to ``next_event``.
+    """
+
+    def __init__(self, sock, parser: HTTPParser, buffer_size: int = 65536):
+        super().__init__(parser)
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+
+    def next_event(self):
+        """Return the next event, or None once the peer has closed."""
+        while not self._events:
+            if self.eof:
+                return None
+            self._received(self.buffer, self.sock.recv_into(self.buffer))
+        return self._events.popleft()
+
+    def iter_body(self):
+        """Yield the current message's body pieces up to its EndOfMessage."""
+        while True:
+            event = self.next_event()
+            if event is None:
+                raise ProtocolError("connection closed mid-body")
+            if isinstance(event, EndOfMessage):
+                return
+            yield event.data
+
+
+class AsyncMessageReader(_EventQueue):
+    """``MessageReader`` for an asyncio StreamReader."""
+
+    def __init__(self, reader, parser: HTTPParser, read_size: int = 65536):
+        super().__init__(parser)
+        self.reader = reader
+        self.read_size = read_size
+
+    async def next_event(self):
+        """Return the next event, or None once the peer has closed."""
+        while not self._events:
+            if self.eof:
+                return None
+            data = await self.reader.read(self.read_size)
+            self._received(data, len(data))
+        return self._events.popleft()
+
+    async def iter_body(self):
+        """Yield the current message's body pieces up to its EndOfMessage."""
+        while True:
+            event = await self.next_event()
+            if event is None:
+                raise ProtocolError("connection closed mid-body")
+            if isinstance(event, EndOfMessage):
+                return
+            yield event.data
+
+
+def iter_file_body(rfile, parser: HTTPParser, read_size: int = 65536):
+    """Yield the body of the message whose head ``parser`` has just parsed.
+
+    ``rfile`` is a buffered binary file (e.g. a handler's ``rfile``); it is
+    never read past the end of the message, so whatever follows stays there
+    for its owner.
+    """
+    while True:
+        wanted = parser.wanted
+        if wanted is None:
+            data = rfile.readline(MAX_LINE_SIZE + 1)
+        else:
+            data = rfile.read(min(wanted, read_size))
+        if not data:
+            raise ProtocolError("connection closed mid-body")
+        for event in parser.feed(data):
+            if isinstance(event, EndOfMessage):
+                return
+            yield event.data
+
+
+def _benchmark(size_mb: int = 64, read_size: int = 65536):
+    """Print parser throughput on large Content-Length and chunked bodies."""
+    size = size_mb * 1024 * 1024
+    payload = b"x" * read_size
+
+    length_stream = [b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % size]
+    length_stream += [payload] * (size // read_size)
+
+    chunk = b"%x\r\n" % 16384 + b"y" * 16384 + b"\r\n"
+    chunked_data = (
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+        + chunk * (size // 16384)
+        + LAST_CHUNK
+    )
+    chunked_stream = [
+        chunked_data[i : i + read_size] for i in range(0, len(chunked_data), read_size)
+    ]
+
+    streams = (("content-length", length_stream), ("chunked", chunked_stream))
+    for label, stream in streams:
+        parser = HTTPParser(is_response=True)
+        parser.expect("GET")
+        received = 0
+        start = time.perf_counter()
+        for data in stream:
+            for event in parser.feed(data):
+                if isinstance(event, Body):
+                    received += len(event.data)
+        elapsed = time.perf_counter() - start
+        assert received == size, (label, received)
+        print(f"{label:<15} {size_mb / elapsed:10.1f} MB/s")
+
+
+if __name__ == "__main__":
+    import sys
+
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
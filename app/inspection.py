@@ -0,0 +1,149 @@
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Tuple
+
+from app.rule_index import host_matches
+
+FULL = "full"
+HEAD = "head"
+SAMPLE = "sample"
+SKIP = "skip"
+ACTIONS = (FULL, HEAD, SAMPLE, SKIP)
+
+
+@dataclass(frozen=True)
+class InspectionRule:
+    """How to scan the responses a rule matches.
+
+    Empty ``content_types`` / ``hosts`` match anything; content types match
+    by prefix (``text/`` covers ``text/html; charset=utf-8``) and hosts also
+    cover their subdomains. Size bounds apply to the Content-Length, so
+    bodies of unknown length only match rules without them. ``head`` scans
+    the first ``limit`` bytes; ``sample`` scans ``limit`` bytes out of every
+    ``interval``.
+    """
+
+    action: str
+    content_types: Tuple[str, ...] = ()
+    hosts: Tuple[str, ...] = ()
+    min_size: Optional[int] = None
+    max_size: Optional[int] = None
+    limit: int = 256 * 1024
+    interval: int = 1024 * 1024
+
+    def __post_init__(self):
+        if self.action not in ACTIONS:
+            raise ValueError(f"Unknown inspection action: {self.action}")
+
+    @property
+    def scan_limit(self) -> Optional[int]:
+        """Bytes scanned from the start (or per sample); None scans everything."""
+        return None if self.action == FULL else self.limit
+
+    @property
+    def sample_interval(self) -> Optional[int]:
+        return self.interval if self.action == SAMPLE else None
+
+    def matches(
+        self, host: str, content_type: str, content_length: Optional[int]
+    ) -> bool:
+        content_type = content_type.lower()
+        if self.content_types and not content_type.startswith(self.content_types):
+            return False
+        if self.hosts and not host_matches(host, self.hosts):
+            return False
+        if self.min_size is not None and (
+            content_length is None or content_length < self.min_size
+        ):
+            return False
+        if self.max_size is not None and (
+            content_length is None or content_length > self.max_size
+        ):
+            return False
+        return True
+
+
+DEFAULT_RULES = (
+    # Nothing a keyword could match in
+    InspectionRule(
+        SKIP,
+        content_types=(
+            "image/",
+            "video/",
+            "audio/",
+            "font/",
+            "application/octet-stream",
+            "application/zip",
+            "application/pdf",
+            "application/wasm",
+        ),
+    ),
+    # Style sheets and bundled scripts are big and rarely carry page text
+    InspectionRule(
+        SAMPLE,
+        content_types=("text/css", "text/javascript", "application/javascript"),
+        min_size=256 * 1024,
+    ),
+    # For very large documents the start is what a reader sees
+    InspectionRule(
+        HEAD, content_types=("text/",), min_size=8 * 1024 * 1024, limit=1024 * 1024
+    ),
+    InspectionRule(
+        FULL,
+        content_types=(
+            "text/",
+            "application/json",
+            "application/xml",
+            "application/xhtml+xml",
+        ),
+    ),
+)
+
+
+class InspectionPolicy:
+    """Decides per response how much of its body the content filter scans.
+
+    The first matching rule wins; responses no rule matches get
+    ``default``. Also counts the body bytes scanned and skipped, and the
+    decisions taken, across every handler thread.
+    """
+
+    def __init__(
+        self,
+        rules: Iterable[InspectionRule] = DEFAULT_RULES,
+        default: InspectionRule = InspectionRule(SKIP),
+    ):
+        self.rules: Tuple[InspectionRule, ...] = tuple(rules)
+        self.default = default
+        self._lock = threading.Lock()
+        self._decisions: Dict[str, int] = dict.fromkeys(ACTIONS, 0)
+        self._scanned = 0
+        self._skipped = 0
+
+    def decide(
+        self, host: str, content_type: str, content_length: Optional[int]
+    ) -> InspectionRule:
+        rule = next(
+            (r for r in self.rules if r.matches(host, content_type, content_length)),
+            self.default,
+        )
+        with self._lock:
+            self._decisions[rule.action] += 1
+        return rule
+
+    def record(self, scanned: int, skipped: int):
+        with self._lock:
+            self._scanned += scanned
+            self._skipped += skipped
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "scanned_bytes": self._scanned,
+                "skipped_bytes": self._skipped,
+                **{f"{action}_responses": n for action, n in self._decisions.items()},
+            }
+
+
+# Shared by every handler thread
+inspection_policy = InspectionPolicy()
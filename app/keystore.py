@@ -0,0 +1,93 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from utils.logger import logger
+
+
+class CertificateStore:
+    """Single-file keystore of MITM certificates and keys.
+
+    Pairs are stored DER-encoded in one SQLite table keyed by certificate
+    name instead of as two PEM files per host. The names and expiry times
+    are kept in memory, so checking for a certificate never touches disk;
+    expired rows are pruned when the store opens and on ``prune``.
+    """
+
+    def __init__(self, path: str = "certs/keystore.db", renew_before: float = 86400):
+        self.path = path
+        # Certificates this close to expiry are treated as missing and re-minted
+        self.renew_before = renew_before
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS certificates ("
+            " name TEXT PRIMARY KEY,"
+            " cert BLOB NOT NULL,"
+            " key BLOB NOT NULL,"
+            " not_after REAL NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+        # name -> not_after timestamp of every stored certificate
+        self._index: Dict[str, float] = {}
+
+        self.prune()
+        self._index = dict(self._db.execute("SELECT name, not_after FROM certificates"))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name: str) -> bool:
+        not_after = self._index.get(name)
+        return not_after is not None and not_after - self.renew_before > time.time()
+
+    def get(self, name: str) -> Optional[Tuple[bytes, bytes]]:
+        """Return the DER ``(certificate, private_key)`` for name, if still valid."""
+        if name not in self:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                "SELECT cert, key FROM certificates WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            self._index.pop(name, None)
+            return None
+        return row[0], row[1]
+
+    def put(self, name: str, cert_der: bytes, key_der: bytes, not_after: float):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO certificates VALUES (?, ?, ?, ?, ?)",
+                (name, cert_der, key_der, not_after, time.time()),
+            )
+            self._db.commit()
+            self._index[name] = not_after
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Delete expired certificates; returns how many were removed."""
+        now = time.time() if now is None else now
+        with self._lock:
+            removed = self._db.execute(
+                "DELETE FROM certificates WHERE not_after <= ?", (now,)
+            ).rowcount
+            self._db.commit()
+            self._index = {
+                name: not_after
+                for name, not_after in self._index.items()
+                if not_after > now
+            }
+        if removed:
+            logger.info(f"[KEYSTORE] pruned {removed} expired certificates")
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
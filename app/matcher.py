@@ -0,0 +1,210 @@
+import time
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Up to this many keywords one C-level ``in`` scan per keyword beats the
+# pure-Python automaton (see ``python -m app.matcher``)
+LOOP_THRESHOLD = 100
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton over bytes.
+
+    Every pattern is found in a single pass over the input, so the cost of a
+    search depends on the input length rather than on the number of patterns.
+    Failure links are resolved while building, turning the automaton into a
+    DFA that takes exactly one lookup per input byte. Each state's dict holds
+    only the transitions that differ from the root's, which keeps large
+    pattern sets compact. With ``ignore_case`` ASCII letters match in either
+    case.
+    """
+
+    def __init__(self, patterns: Iterable[bytes], ignore_case: bool = False):
+        self.patterns: List[bytes] = list(patterns)
+        self.ignore_case = ignore_case
+
+        trie = {}
+        children: List[List[Tuple[int, int]]] = [[]]
+        outputs: List[Tuple[int, ...]] = [()]
+
+        for index, pattern in enumerate(self.patterns):
+            if ignore_case:
+                pattern = pattern.lower()
+            state = 0
+            for byte in pattern:
+                key = state << 8 | byte
+                next_state = trie.get(key)
+                if next_state is None:
+                    next_state = len(outputs)
+                    trie[key] = next_state
+                    children[state].append((byte, next_state))
+                    children.append([])
+                    outputs.append(())
+                state = next_state
+            outputs[state] += (index,)
+
+        root = [0] * 256
+        for byte, child in children[0]:
+            root[byte] = child
+
+        # Breadth-first pass: each state inherits the transitions of its
+        # failure state, so a mismatch never has to walk failure links
+        fail = [0] * len(outputs)
+        rows: List[Dict[int, int]] = [{} for _ in outputs]
+        queue = deque(child for _, child in children[0])
+        while queue:
+            state = queue.popleft()
+            fallback = fail[state]
+            row = dict(rows[fallback])
+            for byte, child in children[state]:
+                queue.append(child)
+                fail[child] = rows[fallback].get(byte, root[byte])
+                if outputs[fail[child]]:
+                    outputs[child] += outputs[fail[child]]
+                row[byte] = child
+            rows[state] = row
+
+        # Renumber so accepting states come last; a scan then detects a
+        # match with one comparison instead of an outputs lookup
+        order = sorted(range(len(outputs)), key=lambda state: bool(outputs[state]))
+        renumber = [0] * len(order)
+        for new, old in enumerate(order):
+            renumber[old] = new
+        self._accept_from = sum(1 for found in outputs if not found)
+        self._outputs = [outputs[old] for old in order]
+
+        self._root = [renumber[state] for state in root]
+        self._rows: List[Dict[int, int]] = []
+        for old in order:
+            row = {byte: renumber[target] for byte, target in rows[old].items()}
+            if ignore_case:
+                row.update(
+                    (byte - 32, target)
+                    for byte, target in list(row.items())
+                    if ord("a") <= byte <= ord("z")
+                )
+            self._rows.append(row)
+        if ignore_case:
+            for byte in range(ord("a"), ord("z") + 1):
+                self._root[byte - 32] = self._root[byte]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def iter_matches(self, data: bytes) -> Iterator[Tuple[int, int]]:
+        """Yield ``(end_position, pattern_index)`` for every occurrence in data."""
+        rows, root, accept_from = self._rows, self._root, self._accept_from
+        state = 0
+        for position, byte in enumerate(data):
+            state = rows[state].get(byte, root[byte])
+            if state >= accept_from:
+                for index in self._outputs[state]:
+                    yield position, index
+
+    def search(self, data, state: int = 0) -> Tuple[Optional[int], int]:
+        """Scan data from ``state`` up to the first match.
+
+        Returns ``(pattern_index or None, state)``; passing the state back in
+        with the next chunk continues the search across chunk boundaries.
+        """
+        rows, root, accept_from = self._rows, self._root, self._accept_from
+        for byte in data:
+            state = rows[state].get(byte, root[byte])
+            if state >= accept_from:
+                return self._outputs[state][0], state
+        return None, state
+
+
+class KeywordMatcher:
+    """Case-insensitive search for any of the content filter's keywords.
+
+    Bodies are scanned as bytes, without decoding them. Large keyword sets
+    go through one ``AhoCorasick`` pass; small ones are faster as one
+    ``in`` per keyword over an ASCII-lowercased copy. Non-ASCII keywords
+    match in their lower- and upper-case spellings.
+    """
+
+    def __init__(self, keywords: Iterable[str], loop_threshold: int = LOOP_THRESHOLD):
+        self.keywords: Tuple[str, ...] = tuple(dict.fromkeys(k for k in keywords if k))
+
+        # ASCII-lowercased UTF-8 spelling -> keyword
+        spellings: Dict[bytes, str] = {}
+        for keyword in self.keywords:
+            for spelling in (keyword.lower(), keyword.upper()):
+                spellings.setdefault(spelling.encode("utf-8").lower(), keyword)
+        self._spellings = list(spellings.items())
+        # Longest keyword in bytes; a stream scan never needs more context
+        self.max_length = max((len(s) for s in spellings), default=0)
+        self._overlap = max(self.max_length - 1, 0)
+
+        self._automaton: Optional[AhoCorasick] = None
+        if len(self.keywords) > loop_threshold:
+            self._automaton = AhoCorasick(spellings, ignore_case=True)
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def search(self, data, state=None) -> Tuple[Optional[str], object]:
+        """Scan data from ``state``; returns ``(keyword or None, state)``.
+
+        Pass the returned state with the next chunk to continue a stream
+        without missing keywords that straddle chunk boundaries.
+        """
+        if self._automaton is not None:
+            index, state = self._automaton.search(data, state or 0)
+            return (None if index is None else self._spellings[index][1]), state
+
+        # The tail of the previous chunk is the state of the loop scan
+        window = (state or b"") + bytes(data).lower()
+        for spelling, keyword in self._spellings:
+            if spelling in window:
+                return keyword, b""
+        return None, window[-self._overlap :] if self._overlap else b""
+
+    def find(self, data) -> Optional[str]:
+        """Return the first keyword found in data (bytes or str), if any."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return self.search(data)[0]
+
+
+def _benchmark(keyword_count: int = 2000, size_mb: int = 4):
+    """Compare both matcher strategies with the old decode-lowercase-loop scan."""
+    import random
+
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    keywords = [
+        "".join(rng.choice(letters) for _ in range(rng.randint(6, 12)))
+        for _ in range(keyword_count)
+    ]
+    words = ["".join(rng.choice(letters) for _ in range(5)) for _ in range(5000)]
+    text = " ".join(rng.choice(words).capitalize() for _ in range(size_mb * 180000))
+    body = text.encode("utf-8")
+
+    start = time.perf_counter()
+    automaton = KeywordMatcher(keywords, loop_threshold=0)
+    build = time.perf_counter() - start
+    print(f"{keyword_count} keywords, {len(body) / 1e6:.1f} MB body")
+    print(f"automaton built in {build:.2f}s")
+
+    def old_loop(data):
+        content_lower = data.decode("utf-8", errors="ignore").lower()
+        return next((k for k in keywords if k in content_lower), None)
+
+    strategies = (
+        ("decode + loop", old_loop),
+        ("bytes loop", KeywordMatcher(keywords, loop_threshold=len(keywords)).find),
+        ("aho-corasick", automaton.find),
+    )
+    for label, find in strategies:
+        start = time.perf_counter()
+        match = find(body)
+        elapsed = time.perf_counter() - start
+        print(f"{label:<15} {len(body) / 1e6 / elapsed:8.1f} MB/s  match={match}")
+
+
+if __name__ == "__main__":
+    import sys
+
+    _benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,194 @@
+import ipaddress
+import os
+from functools import lru_cache
+from typing import FrozenSet, NamedTuple, Optional
+
+from utils.logger import logger
+
+# Copy of https://publicsuffix.org/list/public_suffix_list.dat (MPL 2.0);
+# refresh it from there now and then
+PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(__file__), "public_suffix_list.dat")
+
+# Used only when the list file cannot be read: common multi-label suffixes under
+# which every label belongs to a different owner. Single-label TLDs are implied.
+FALLBACK_SUFFIXES = frozenset(
+    {
+        # ICANN section
+        "ac.uk",
+        "co.uk",
+        "gov.uk",
+        "ltd.uk",
+        "me.uk",
+        "net.uk",
+        "nhs.uk",
+        "org.uk",
+        "plc.uk",
+        "sch.uk",
+        "asn.au",
+        "com.au",
+        "edu.au",
+        "gov.au",
+        "id.au",
+        "net.au",
+        "org.au",
+        "ac.nz",
+        "co.nz",
+        "geek.nz",
+        "govt.nz",
+        "net.nz",
+        "org.nz",
+        "ac.jp",
+        "co.jp",
+        "go.jp",
+        "ne.jp",
+        "or.jp",
+        "co.kr",
+        "ne.kr",
+        "or.kr",
+        "com.br",
+        "gov.br",
+        "net.br",
+        "org.br",
+        "com.cn",
+        "edu.cn",
+        "gov.cn",
+        "net.cn",
+        "org.cn",
+        "com.hk",
+        "org.hk",
+        "com.tw",
+        "org.tw",
+        "com.sg",
+        "edu.sg",
+        "com.my",
+        "com.ph",
+        "com.vn",
+        "co.th",
+        "in.th",
+        "co.id",
+        "or.id",
+        "co.in",
+        "firm.in",
+        "gen.in",
+        "ind.in",
+        "net.in",
+        "org.in",
+        "co.za",
+        "org.za",
+        "co.il",
+        "org.il",
+        "com.ar",
+        "com.mx",
+        "com.tr",
+        "com.ua",
+        "com.pk",
+        "com.eg",
+        "com.sa",
+        "com.co",
+        "com.pe",
+        "com.ve",
+        # Private section: hosting platforms handing out subdomains
+        "appspot.com",
+        "blogspot.com",
+        "cloudfront.net",
+        "azurewebsites.net",
+        "cloudapp.net",
+        "azureedge.net",
+        "firebaseapp.com",
+        "github.io",
+        "githubusercontent.com",
+        "gitlab.io",
+        "herokuapp.com",
+        "netlify.app",
+        "vercel.app",
+        "pages.dev",
+        "workers.dev",
+        "web.app",
+        "fly.dev",
+        "onrender.com",
+        "ngrok.io",
+        "s3.amazonaws.com",
+    }
+)
+
+
+class SuffixRules(NamedTuple):
+    suffixes: FrozenSet[str]
+    # "*.ck" is stored as "ck": every label under it is a public suffix
+    wildcards: FrozenSet[str]
+    # "!www.ck": registrable even though a wildcard covers it
+    exceptions: FrozenSet[str]
+    complete: bool
+
+
+def _to_ascii(rule: str) -> str:
+    # Hosts arrive in their punycode form; the list spells IDN rules in Unicode
+    try:
+        return rule.encode("idna").decode("ascii")
+    except UnicodeError:
+        return rule
+
+
+def parse_suffix_list(lines) -> SuffixRules:
+    """Parse Public Suffix List text, ICANN and private sections alike."""
+    suffixes, wildcards, exceptions = set(), set(), set()
+    for line in lines:
+        rule = line.split(None, 1)[0].lower() if line.strip() else ""
+        if not rule or rule.startswith("//"):
+            continue
+        if rule.startswith("!"):
+            exceptions.add(_to_ascii(rule[1:]))
+        elif rule.startswith("*."):
+            wildcards.add(_to_ascii(rule[2:]))
+        else:
+            suffixes.add(_to_ascii(rule))
+    return SuffixRules(
+        frozenset(suffixes), frozenset(wildcards), frozenset(exceptions), True
+    )
+
+
+@lru_cache(maxsize=None)
+def suffix_rules(path: str = PUBLIC_SUFFIX_LIST) -> SuffixRules:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return parse_suffix_list(f)
+    except OSError as e:
+        logger.warning(f"[PSL] cannot read {path}: {e}; using the built-in subset")
+        return SuffixRules(FALLBACK_SUFFIXES, frozenset(), frozenset(), False)
+
+
+def _suffix_length(labels, rules: SuffixRules) -> Optional[int]:
+    """Number of trailing labels forming the public suffix, None if unknown."""
+    for start in range(len(labels)):
+        name = ".".join(labels[start:])
+        if name in rules.exceptions:
+            return len(labels) - start - 1
+        parent = ".".join(labels[start + 1 :])
+        if name in rules.suffixes or (parent and parent in rules.wildcards):
+            return len(labels) - start
+    if not rules.complete and len(labels[-1]) == 2:
+        # Without the full list a ccTLD may hide an unknown second-level suffix
+        return None
+    # The list's default rule: an unlisted TLD is a public suffix
+    return 1
+
+
+def registrable_domain(host: str) -> Optional[str]:
+    """Return the public suffix plus one label (``a.b.example.co.uk`` -> ``example.co.uk``).
+
+    Returns None for IP addresses, for hosts that are themselves a public
+    suffix, and for ccTLD hosts whose suffix is unknown because the list
+    file could not be read.
+    """
+    host = host.lower().rstrip(".")
+    try:
+        ipaddress.ip_address(host)
+        return None
+    except ValueError:
+        pass
+
+    labels = host.split(".")
+    suffix_length = _suffix_length(labels, suffix_rules())
+    if suffix_length is None or len(labels) <= suffix_length:
+        return None
+    return ".".join(labels[-suffix_length - 1 :])
@@ -0,0 +1,208 @@
+import os
+import selectors
+import socket
+import ssl
+from typing import Dict, Optional
+
+from utils.logger import logger
+
+RELAY_BUFFER_SIZE = 65536
+
+# Linux can move bytes socket -> pipe -> socket without copying them to user space
+SPLICE_AVAILABLE = hasattr(os, "splice")
+_SPLICE_FLAGS = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK if SPLICE_AVAILABLE else 0
+
+_BLOCKED = (
+    BlockingIOError,
+    InterruptedError,
+    ssl.SSLWantReadError,
+    ssl.SSLWantWriteError,
+)
+
+
+class _Flow:
+    """One direction of a relay: bytes read from source and not yet sent on."""
+
+    def __init__(self, source, destination, buffer_size: int, use_splice: bool):
+        self.source = source
+        self.destination = destination
+        self.buffer_size = buffer_size
+        self.pending = 0
+        self.eof = False
+        self.done = False
+        self.transferred = 0
+
+        self.pipe = os.pipe() if use_splice else None
+        self.buffer: Optional[bytearray] = None
+        self.view: Optional[memoryview] = None
+        self.start = 0
+        if self.pipe is None:
+            self._allocate_buffer()
+
+    def _allocate_buffer(self):
+        self.buffer = bytearray(self.buffer_size)
+        self.view = memoryview(self.buffer)
+
+    @property
+    def wants_read(self) -> bool:
+        return not self.eof and not self.pending
+
+    def readable_without_select(self) -> bool:
+        # TLS records already decrypted into the SSL buffer never wake select
+        return (
+            self.wants_read
+            and isinstance(self.source, ssl.SSLSocket)
+            and self.source.pending() > 0
+        )
+
+    def read(self):
+        try:
+            if self.pipe is not None:
+                try:
+                    count = os.splice(
+                        self.source.fileno(),
+                        self.pipe[1],
+                        self.buffer_size,
+                        flags=_SPLICE_FLAGS,
+                    )
+                except OSError as e:
+                    if isinstance(e, _BLOCKED):
+                        raise
+                    # Not spliceable (e.g. an unusual socket type): fall back for good
+                    self.close_pipe()
+                    self._allocate_buffer()
+                    return self.read()
+            else:
+                count = self.source.recv_into(self.buffer)
+                self.start = 0
+        except _BLOCKED:
+            return
+        if not count:
+            self.eof = True
+        self.pending = count
+
+    def write(self):
+        while self.pending:
+            try:
+                if self.pipe is not None:
+                    sent = os.splice(
+                        self.pipe[0],
+                        self.destination.fileno(),
+                        self.pending,
+                        flags=_SPLICE_FLAGS,
+                    )
+                else:
+                    sent = self.destination.send(
+                        self.view[self.start : self.start + self.pending]
+                    )
+                    self.start += sent
+            except _BLOCKED:
+                # Partial send: keep the rest until the destination drains
+                return
+            self.pending -= sent
+            self.transferred += sent
+
+    def finish(self):
+        self.done = True
+        try:
+            self.destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def close_pipe(self):
+        if self.pipe is not None:
+            for fd in self.pipe:
+                os.close(fd)
+            self.pipe = None
+
+
+def relay(
+    first,
+    second,
+    buffer_size: int = RELAY_BUFFER_SIZE,
+    idle_timeout: Optional[float] = None,
+    use_splice: Optional[bool] = None,
+) -> Dict[str, int]:
+    """Copy bytes both ways between two connected sockets until both sides finish.
+
+    A single selector loop drives both directions with preallocated
+    ``recv_into`` buffers and handles partial sends; EOF on one side is
+    forwarded as a half-close (with TLS sockets it ends the relay instead).
+    Plain sockets are spliced through a kernel pipe where the platform
+    supports it. Returns bytes moved per direction.
+    """
+    tls = any(isinstance(sock, ssl.SSLSocket) for sock in (first, second))
+    if use_splice is None:
+        use_splice = SPLICE_AVAILABLE and not tls
+    flows = [
+        _Flow(first, second, buffer_size, use_splice),
+        _Flow(second, first, buffer_size, use_splice),
+    ]
+    for sock in (first, second):
+        sock.setblocking(False)
+
+    selector = selectors.DefaultSelector()
+    registered: Dict[socket.socket, int] = {}
+    try:
+        while not all(flow.done for flow in flows):
+            events: Dict[socket.socket, int] = {}
+            for flow in flows:
+                if flow.done:
+                    continue
+                if flow.pending:
+                    events[flow.destination] = (
+                        events.get(flow.destination, 0) | selectors.EVENT_WRITE
+                    )
+                elif not flow.eof:
+                    events[flow.source] = (
+                        events.get(flow.source, 0) | selectors.EVENT_READ
+                    )
+
+            for sock in list(registered):
+                if sock not in events:
+                    selector.unregister(sock)
+                    del registered[sock]
+            for sock, mask in events.items():
+                if sock not in registered:
+                    selector.register(sock, mask)
+                elif registered[sock] != mask:
+                    selector.modify(sock, mask)
+                registered[sock] = mask
+
+            if any(flow.readable_without_select() for flow in flows):
+                ready = {sock: selectors.EVENT_READ for sock in registered}
+            else:
+                selected = selector.select(idle_timeout)
+                if not selected:
+                    logger.info("[RELAY] idle timeout")
+                    break
+                ready = {key.fileobj: mask for key, mask in selected}
+
+            for flow in flows:
+                if flow.done:
+                    continue
+                if flow.wants_read and ready.get(flow.source, 0) & selectors.EVENT_READ:
+                    flow.read()
+                if flow.pending and (
+                    ready.get(flow.destination, 0) & selectors.EVENT_WRITE
+                    or ready.get(flow.source, 0) & selectors.EVENT_READ
+                ):
+                    # Usually the destination can take it right away
+                    flow.write()
+                if flow.eof and not flow.pending:
+                    if tls:
+                        # TLS has no half-close; one side ending ends the relay
+                        return _totals(flows)
+                    flow.finish()
+    except (ConnectionError, OSError) as e:
+        logger.info(f"[RELAY] closed: {e}")
+    finally:
+        selector.close()
+        for flow in flows:
+            flow.close_pipe()
+
+    return _totals(flows)
+
+
+def _totals(flows) -> Dict[str, int]:
+    return {"sent": flows[0].transferred, "received": flows[1].transferred}
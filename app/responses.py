@@ -0,0 +1,73 @@
+import datetime
+
+
+def blocked_page(reason, url):
+    """Render the HTML page shown when a request is blocked."""
+    return f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Content Blocked</title>
+        </head>
+        <body>
+            <h1>Access Blocked</h1>
+            <p><strong>Reason:</strong> {reason}</p>
+            <p><strong>URL:</strong> {url}</p>
+            <p><strong>Time:</strong> {datetime.datetime.now()}</p>
+        </body>
+        </html>
+        """
+
+
+def error_page(code, message, url):
+    """Render the HTML page shown when the proxy fails to serve a request."""
+    return f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Proxy Error</title>
+        </head>
+        <body>
+            <h1>Proxy Error {code}</h1>
+            <p>{message}</p>
+            <p>URL: {url}</p>
+        </body>
+        </html>
+        """
+
+
+def admin_page(details, sections, blocked_patterns):
+    """Render the proxy admin page.
+
+    ``details`` maps labels to the values listed at the top; ``sections``
+    maps headings to dicts of counters.
+    """
+    detail_html = "".join(
+        f"<p><strong>{label}:</strong> {value}</p>" for label, value in details.items()
+    )
+    section_html = "".join(
+        f"""
+            <h3>{title}</h3>
+            <ul>
+                {''.join(f'<li>{name}: {value}</li>' for name, value in stats.items())}
+            </ul>
+"""
+        for title, stats in sections.items()
+    )
+    return f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Proxy Server Admin</title>
+        </head>
+        <body>
+            <h1>Proxy Server Status</h1>
+            {detail_html}
+            {section_html}
+            <h3>Blocked Domains</h3>
+            <ul>
+                {''.join(f'<li>{pattern}</li>' for pattern in blocked_patterns)}
+            </ul>
+        </body>
+        </html>
+        """
@@ -0,0 +1,198 @@
+import ipaddress
+import time
+from dataclasses import dataclass
+from datetime import timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from app.matcher import AhoCorasick
+
+# Patterns with one of these prefixes match a domain and all of its subdomains
+SUFFIX_PREFIXES = ("*.", ".")
+
+
+@dataclass(frozen=True)
+class CompiledRule:
+    id: int
+    pattern: str
+    scope: str
+    subnet: Optional[str]
+    expires_at: Optional[float]
+
+
+def host_matches(host: str, patterns) -> bool:
+    """True when host equals one of the domains or is a subdomain of one."""
+    host = host.lower().rstrip(".")
+    for pattern in patterns:
+        domain = pattern.lower().lstrip("*").lstrip(".")
+        if host == domain or host.endswith("." + domain):
+            return True
+    return False
+
+
+def _expiry_timestamp(expires_at) -> Optional[float]:
+    if expires_at is None:
+        return None
+    # SQLite hands back naive datetimes even for timezone-aware columns
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at.timestamp()
+
+
+class DomainSuffixTrie:
+    """Trie of reversed domain labels, e.g. ``com -> example -> www``."""
+
+    def __init__(self):
+        self._root: Dict = {}
+
+    def add(self, domain: str, value: int):
+        node = self._root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node.setdefault(None, []).append(value)
+
+    def match(self, host: str) -> List[int]:
+        """Return the values of every stored domain that host equals or is under."""
+        found = []
+        node = self._root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+        return found
+
+
+class SubnetTrie:
+    """Binary radix tree of IPv4 and IPv6 networks.
+
+    Each network is stored at the node reached by walking its prefix bits, so
+    walking a client address once collects every network that contains it.
+    """
+
+    def __init__(self):
+        # Node layout: [zero_child, one_child, values]
+        self._roots = {4: [None, None, []], 6: [None, None, []]}
+
+    def add(self, subnet: str, value: int) -> bool:
+        try:
+            network = ipaddress.ip_network(subnet, strict=False)
+        except ValueError:
+            return False
+
+        node = self._roots[network.version]
+        address = int(network.network_address)
+        for depth in range(network.prefixlen):
+            bit = (address >> (network.max_prefixlen - 1 - depth)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, []]
+            node = node[bit]
+        node[2].append(value)
+        return True
+
+    def match(self, ip: str) -> List[int]:
+        """Return the values of every stored network containing ip."""
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return []
+
+        node = self._roots[address.version]
+        found = list(node[2])
+        value = int(address)
+        for shift in range(address.max_prefixlen - 1, -1, -1):
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+            found.extend(node[2])
+        return found
+
+
+class DomainRuleIndex:
+    """Compiled, read-only view of the active block rules.
+
+    Plain patterns keep their legacy substring semantics and are matched with
+    an Aho-Corasick automaton; ``*.example.com`` / ``.example.com`` patterns
+    match ``example.com`` and its subdomains through a reversed-label trie.
+    Either way a lookup costs O(host length) and never touches the database.
+    Subnet-scoped rules are resolved with a single walk of a SubnetTrie.
+    """
+
+    def __init__(self, rules: Iterable):
+        # Keep database order so the first applicable rule wins, as before
+        self.rules: List[CompiledRule] = [
+            CompiledRule(
+                id=rule.id,
+                pattern=rule.pattern,
+                scope=rule.scope,
+                subnet=rule.subnet,
+                expires_at=_expiry_timestamp(rule.expires_at),
+            )
+            for rule in sorted(rules, key=lambda rule: rule.id)
+        ]
+
+        self._suffixes = DomainSuffixTrie()
+        self._subnets = SubnetTrie()
+        self._global_rules: Set[int] = set()
+        # Rules sharing a pattern share one automaton entry
+        substring_rules: Dict[str, List[int]] = {}
+
+        for position, rule in enumerate(self.rules):
+            if rule.scope == "global":
+                self._global_rules.add(position)
+            elif rule.scope == "subnet" and rule.subnet:
+                self._subnets.add(rule.subnet, position)
+
+            pattern = rule.pattern.lower()
+            if pattern.startswith(SUFFIX_PREFIXES):
+                self._suffixes.add(pattern.split(".", 1)[1], position)
+            else:
+                substring_rules.setdefault(pattern, []).append(position)
+
+        self._substring_rules: List[List[int]] = list(substring_rules.values())
+        self._substrings = AhoCorasick(
+            pattern.encode("utf-8") for pattern in substring_rules
+        )
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _matching_positions(self, host: str) -> Set[int]:
+        host_lower = host.lower()
+        positions: Set[int] = set(self._suffixes.match(host_lower))
+        for _, index in self._substrings.iter_matches(host_lower.encode("utf-8")):
+            positions.update(self._substring_rules[index])
+        return positions
+
+    def matching_rules(self, host: str) -> List[CompiledRule]:
+        """Return every rule whose pattern matches host, in database order."""
+        positions = sorted(self._matching_positions(host))
+        return [self.rules[position] for position in positions]
+
+    def lookup(
+        self, host: str, client_ip: Optional[str] = None
+    ) -> Tuple[bool, Optional[str]]:
+        positions = self._matching_positions(host)
+        if not positions:
+            return False, None
+
+        applicable = positions & self._global_rules
+        if client_ip:
+            # One walk of the client address covers every subnet rule
+            applicable |= positions.intersection(self._subnets.match(client_ip))
+
+        now = time.time()
+        for position in sorted(applicable):
+            rule = self.rules[position]
+            if rule.expires_at is not None and rule.expires_at <= now:
+                continue
+            if rule.scope == "global":
+                return True, f"Blocked globally: {rule.pattern}"
+            return True, f"Blocked for subnet {rule.subnet}: {rule.pattern}"
+
+        return False, None
+
+    def rules_for_client(self, client_ip: str) -> List[CompiledRule]:
+        """Return every subnet-scoped rule that applies to client_ip."""
+        return [
+            self.rules[position] for position in sorted(self._subnets.match(client_ip))
+        ]
@@ -0,0 +1,187 @@
+import select
+import ssl
+import threading
+import time
+from collections import deque
+from http.client import HTTPConnection, HTTPSConnection
+from typing import Deque, Dict, Tuple
+
+from utils.logger import logger
+
+Origin = Tuple[str, str]
+
+
+class PoolTimeout(Exception):
+    """Raised when no upstream connection frees up within the pool timeout."""
+
+
+def _is_stale(conn: HTTPConnection) -> bool:
+    """An idle keep-alive socket that is readable has been closed or is out of sync."""
+    sock = conn.sock
+    if sock is None:
+        return True
+    try:
+        if hasattr(select, "poll"):
+            # select() rejects descriptors >= FD_SETSIZE, which busy proxies reach
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return bool(poller.poll(0))
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return True
+    return bool(readable)
+
+
+class UpstreamConnectionPool:
+    """Thread-safe pool of keep-alive connections to upstream origins.
+
+    Connections are keyed by ``(scheme, netloc)``. At most ``max_per_host``
+    connections per origin are open at once and at most ``max_idle_per_host``
+    of them are kept idle for reuse; idle ones older than ``idle_timeout``
+    seconds are closed. All HTTPS connections share one SSL context.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host: int = 8,
+        max_per_host: int = 32,
+        idle_timeout: float = 60,
+        timeout: float = 30,
+        acquire_timeout: float = 30,
+    ):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.acquire_timeout = acquire_timeout
+
+        # Upstream certificates are not verified, matching the original forwarder
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+
+        self._idle: Dict[Origin, Deque[Tuple[HTTPConnection, float]]] = {}
+        self._active: Dict[Origin, int] = {}
+        self._cond = threading.Condition()
+        self._last_sweep = time.monotonic()
+
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def _new_connection(self, scheme: str, netloc: str) -> HTTPConnection:
+        if scheme == "https":
+            return HTTPSConnection(
+                netloc, timeout=self.timeout, context=self.ssl_context
+            )
+        return HTTPConnection(netloc, timeout=self.timeout)
+
+    def acquire(
+        self, scheme: str, netloc: str, fresh: bool = False
+    ) -> Tuple[HTTPConnection, bool]:
+        """Check out a connection to the origin; returns ``(conn, reused)``.
+
+        ``fresh`` skips idle connections, e.g. to retry after a stale one failed.
+        """
+        origin = (scheme, netloc)
+        deadline = time.monotonic() + self.acquire_timeout
+        discarded = []
+        conn = None
+        reused = False
+
+        with self._cond:
+            self._maybe_sweep()
+            while True:
+                idle = self._idle.setdefault(origin, deque())
+                while idle and not fresh:
+                    candidate, _ = idle.pop()
+                    if _is_stale(candidate):
+                        discarded.append(candidate)
+                        continue
+                    conn, reused = candidate, True
+                    break
+
+                if conn is None and idle:
+                    # Recycle an idle slot rather than wait for an active one
+                    discarded.append(idle.popleft()[0])
+
+                open_count = self._active.get(origin, 0) + len(idle)
+                if conn is None and open_count < self.max_per_host:
+                    conn = self._new_connection(scheme, netloc)
+
+                if conn is not None:
+                    self._active[origin] = self._active.get(origin, 0) + 1
+                    if reused:
+                        self.reused += 1
+                    else:
+                        self.created += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(f"No upstream connection available for {netloc}")
+                self._cond.wait(remaining)
+
+        for old in discarded:
+            old.close()
+        return conn, reused
+
+    def release(self, scheme: str, netloc: str, conn: HTTPConnection, reusable: bool):
+        """Return a connection whose response has been fully read."""
+        origin = (scheme, netloc)
+        with self._cond:
+            self._active[origin] = max(0, self._active.get(origin, 0) - 1)
+            idle = self._idle.setdefault(origin, deque())
+            if (
+                reusable
+                and conn.sock is not None
+                and len(idle) < self.max_idle_per_host
+            ):
+                idle.append((conn, time.monotonic()))
+                conn = None
+            self._cond.notify()
+
+        if conn is not None:
+            conn.close()
+
+    def _maybe_sweep(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.idle_timeout / 2:
+            return
+        self._last_sweep = now
+
+        expired = []
+        for origin, idle in list(self._idle.items()):
+            while idle and now - idle[0][1] > self.idle_timeout:
+                expired.append(idle.popleft()[0])
+            if not idle and not self._active.get(origin):
+                del self._idle[origin]
+                self._active.pop(origin, None)
+
+        self.evicted += len(expired)
+        for conn in expired:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.debug(f"[POOL] error closing idle connection: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+                "idle": sum(len(idle) for idle in self._idle.values()),
+                "active": sum(self._active.values()),
+            }
+
+    def close(self):
+        """Close every idle connection."""
+        with self._cond:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                conn.close()
+
+
+upstream_pool = UpstreamConnectionPool()
@@ -2,8 +2,11 @@
 import asyncio
 import threading
 from functools import partial
-from typing import Optional
+from typing import Iterable, Optional
 
+from app.async_proxy import AsyncHTTPProxy
+from app.db.gateway import db_gateway
+from app.db.log_writer import traffic_log_writer
 from app.db.session import init_db
 from app.filter import ContentFilter
 from app.GUI import ContentFilterGUI
@@ -12,15 +15,40 @@ from app.thread import ThreadedHTTPProxy
 
 
 def create_http_proxy(
-    host: str = "localhost", port: int = 8080, filter: Optional[ContentFilter] = None
+    host: str = "localhost",
+    port: int = 8080,
+    filter: Optional[ContentFilter] = None,
+    engine: str = "threaded",
+    prewarm_hosts: Iterable[str] = (),
 ):
-    """Create and start HTTP proxy server."""
+    """Create and start HTTP proxy server.
+
+    ``engine`` selects the server core: ``"threaded"`` runs one thread per
+    connection, ``"asyncio"`` serves every connection from a single event loop.
+    MITM certificates for ``prewarm_hosts`` are minted in the background.
+    """
     if filter is None:
-        proxy = ThreadedHTTPProxy((host, port), ProxyHTTPRequestHandler)
-    else:
-        handler_class = partial(ProxyHTTPRequestHandler, content_filter=filter)
+        filter = ContentFilter()
 
+    if engine == "asyncio":
+        proxy = AsyncHTTPProxy(
+            (host, port),
+            content_filter=filter,
+            mitm_mode=ProxyHTTPRequestHandler.mitm_mode,
+            passthrough_hosts=ProxyHTTPRequestHandler.passthrough_hosts,
+        )
+    elif engine == "threaded":
+        handler_class = partial(ProxyHTTPRequestHandler, content_filter=filter)
         proxy = ThreadedHTTPProxy((host, port), handler_class)
+    else:
+        raise ValueError(f"Unknown proxy engine: {engine}")
+
+    server_contexts = (
+        proxy.server_contexts
+        if engine == "asyncio"
+        else ProxyHTTPRequestHandler.server_contexts
+    )
+    server_contexts.prewarm(prewarm_hosts)
 
     print(f"Starting HTTP Proxy Server on http://{host}:{port}")
     print(f"Admin interface: http://{host}:{port}/proxy-admin")
@@ -35,6 +63,9 @@ def create_http_proxy(
         print("\nShutting down proxy server...")
         proxy.shutdown()
         proxy.server_close()
+        server_contexts.close()
+        traffic_log_writer.close()
+        db_gateway.stop()
 
 
 if __name__ == "__main__":
@@ -44,5 +75,10 @@ if __name__ == "__main__":
         target=create_http_proxy, args=("localhost", 8080, filter), daemon=True
     )
     proxy_thread.start()
-    app = ContentFilterGUI()
+    # Share the filter so rule edits in the GUI refresh the proxy's index
+    app = ContentFilterGUI(filter)
     app.run()
+
+    # Flush buffered traffic logs before the daemon threads are torn down
+    traffic_log_writer.close()
+    db_gateway.stop()
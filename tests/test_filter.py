@@ -0,0 +1,107 @@
+import gzip
+import unittest
+import tracemalloc
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from app.decoding import SUPPORTED_CODINGS, ContentDecoder, DecodingError
+from app.filter import ContentBlockedError, ContentFilter, StreamingContentScanner
+
+
+def scan(scanner, pieces):
+    """Feed pieces; return ``(released bytes, blocked)``."""
+    released = b""
+    try:
+        for piece in pieces:
+            released += scanner.feed(piece)
+        released += scanner.finish()
+    except ContentBlockedError:
+        return released, True
+    return released, False
+
+
+class StreamingContentScannerTests(unittest.TestCase):
+    def setUp(self):
+        self.filter = ContentFilter(["malware", "phishing"])
+
+    def test_keyword_split_across_chunks(self):
+        body = b"a" * 50 + b"some MalWare here" + b"b" * 50
+        for i in range(len(body) + 1):
+            scanner = StreamingContentScanner(self.filter)
+            released, blocked = scan(scanner, [body[:i], body[i:]])
+            self.assertTrue(blocked, i)
+            self.assertNotIn(b"malware", released.lower(), i)
+
+    def test_clean_body_is_released_unchanged(self):
+        body = b"nothing to see here, " * 100
+        for size in (1, 3, 7, 64, 4096):
+            pieces = [body[i : i + size] for i in range(0, len(body), size)]
+            released, blocked = scan(StreamingContentScanner(self.filter), pieces)
+            self.assertFalse(blocked)
+            self.assertEqual(released, body)
+
+    def test_gzip_body_fed_byte_by_byte(self):
+        encoded = gzip.compress(b"x" * 1000 + b"phishing" + b"y" * 1000)
+        pieces = [encoded[i : i + 1] for i in range(len(encoded))]
+        _, blocked = scan(StreamingContentScanner(self.filter, "gzip"), pieces)
+        self.assertTrue(blocked)
+
+        clean = gzip.compress(b"x" * 5000)
+        pieces = [clean[i : i + 5] for i in range(0, len(clean), 5)]
+        released, blocked = scan(StreamingContentScanner(self.filter, "gzip"), pieces)
+        self.assertFalse(blocked)
+        self.assertEqual(released, clean)
+
+    def test_scan_limit_stops_inspection(self):
+        body = b"z" * 1000 + b"malware"
+        scanner = StreamingContentScanner(self.filter, scan_limit=500)
+        pieces = [body[i : i + 100] for i in range(0, len(body), 100)]
+        released, blocked = scan(scanner, pieces)
+        self.assertFalse(blocked)
+        self.assertEqual(released, body)
+        self.assertEqual(scanner.scanned, 500)
+
+
+class ContentDecoderTests(unittest.TestCase):
+    def test_deflate_with_one_byte_first_chunk(self):
+        text = b"hello world " * 100
+        data = zlib.compress(text)
+        decoder = ContentDecoder("deflate")
+        self.assertEqual(decoder.decode(data[:1]) + decoder.decode(data[1:]), text)
+
+    def test_raw_deflate(self):
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        data = compressor.compress(b"raw " * 100) + compressor.flush()
+        decoder = ContentDecoder("deflate")
+        decoded = b"".join(decoder.decode(data[i : i + 3]) for i in range(0, len(data), 3))
+        self.assertEqual(decoded, b"raw " * 100)
+
+    @unittest.skipUnless("br" in SUPPORTED_CODINGS, "bounded brotli not available")
+    def test_brotli_fed_in_pieces(self):
+        text = b"brotli text " * 1000
+        data = brotli.compress(text)
+        decoder = ContentDecoder("br")
+        decoded = b"".join(decoder.decode(data[i : i + 7]) for i in range(0, len(data), 7))
+        self.assertEqual(decoded, text)
+
+    @unittest.skipUnless("br" in SUPPORTED_CODINGS, "bounded brotli not available")
+    def test_brotli_bomb_stops_near_the_limit(self):
+        # 128 MiB of one byte compresses to a few KiB, one small feed
+        bomb = brotli.compress(b"a" * (128 * 1024 * 1024), quality=1)
+        decoder = ContentDecoder("br", max_output=1024 * 1024)
+        tracemalloc.start()
+        try:
+            with self.assertRaises(DecodingError):
+                decoder.decode(bomb)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 16 * 1024 * 1024)
+
+
+if __name__ == "__main__":
+    unittest.main()
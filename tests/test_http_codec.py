@@ -0,0 +1,144 @@
+import io
+import unittest
+
+from app.http_codec import (
+    Body,
+    EndOfMessage,
+    Head,
+    HTTPParser,
+    ProtocolError,
+    iter_file_body,
+)
+
+
+def parse(parser, pieces):
+    """Feed pieces one by one; return heads and bodies in order."""
+    messages = []
+    for piece in pieces:
+        for event in parser.feed(piece):
+            if isinstance(event, Head):
+                messages.append([event, b""])
+            elif isinstance(event, Body):
+                messages[-1][1] += bytes(event.data)
+            elif isinstance(event, EndOfMessage):
+                messages[-1].append("end")
+    return messages
+
+
+def splits(data):
+    """Every way of cutting data into two pieces."""
+    for i in range(len(data) + 1):
+        yield [data[:i], data[i:]]
+
+
+class HTTPParserTests(unittest.TestCase):
+    def test_content_length_request_fed_byte_by_byte(self):
+        data = b"POST /u HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello"
+        pieces = [data[i : i + 1] for i in range(len(data))]
+        messages = parse(HTTPParser(is_response=False), pieces)
+        self.assertEqual(len(messages), 1)
+        head, body, end = messages[0]
+        self.assertEqual(
+            (head.method, head.target, head.framing), ("POST", "/u", "length")
+        )
+        self.assertEqual(body, b"hello")
+
+    def test_chunked_response_split_anywhere(self):
+        data = (
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5;ext=1\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n"
+        )
+        for pieces in splits(data):
+            parser = HTTPParser(is_response=True)
+            parser.expect("GET")
+            messages = parse(parser, pieces)
+            self.assertEqual(len(messages), 1, pieces)
+            self.assertEqual(messages[0][1:], [b"hello world", "end"], pieces)
+            self.assertTrue(parser.idle)
+
+    def test_pipelined_requests_in_one_buffer(self):
+        data = (
+            b"POST /a HTTP/1.1\r\nContent-Length: 3\r\n\r\nabc"
+            b"POST /b HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"2\r\nde\r\n0\r\n\r\n"
+            b"GET /c HTTP/1.1\r\nHost: x\r\n\r\n"
+        )
+        for pieces in splits(data):
+            messages = parse(HTTPParser(is_response=False), pieces)
+            self.assertEqual(
+                [(head.target, body, end) for head, body, end in messages],
+                [("/a", b"abc", "end"), ("/b", b"de", "end"), ("/c", b"", "end")],
+            )
+
+    def test_head_response_has_no_body(self):
+        parser = HTTPParser(is_response=True)
+        parser.expect("HEAD")
+        parser.expect("GET")
+        data = (
+            b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n"
+            b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+        )
+        messages = parse(parser, [data])
+        self.assertEqual([body for _, body, _ in messages], [b"", b"ok"])
+
+    def test_close_delimited_body_ends_at_eof(self):
+        parser = HTTPParser(is_response=True)
+        parser.expect("GET")
+        messages = parse(parser, [b"HTTP/1.0 200 OK\r\n\r\nsome", b" data"])
+        self.assertEqual(messages[0][1:], [b"some data"])
+        self.assertIsInstance(parser.feed_eof()[-1], EndOfMessage)
+
+    def test_truncated_body_is_an_error(self):
+        parser = HTTPParser(is_response=True)
+        parser.expect("GET")
+        parser.feed(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc")
+        with self.assertRaises(ProtocolError):
+            parser.feed_eof()
+
+    def test_malformed_chunk_sizes_are_rejected(self):
+        for size in (b"-6", b"+5", b" 0x5", b"0x5", b""):
+            with self.subTest(size=size):
+                parser = HTTPParser(is_response=False)
+                with self.assertRaises(ProtocolError):
+                    parser.feed(
+                        b"POST / HTTP/1.1\r\nHost: a\r\n"
+                        b"Transfer-Encoding: chunked\r\n\r\n" + size + b"\r\nxx"
+                    )
+
+    def test_malformed_content_lengths_are_rejected(self):
+        for value in (b"-1", b"+5", b" 0x5", b"5_0", b"5, 6"):
+            with self.subTest(value=value):
+                parser = HTTPParser(is_response=False)
+                with self.assertRaises(ProtocolError):
+                    parser.feed(
+                        b"POST / HTTP/1.1\r\nContent-Length: " + value + b"\r\n\r\nabc"
+                    )
+
+    def test_repeated_identical_content_lengths_are_accepted(self):
+        parser = HTTPParser(is_response=False)
+        messages = parse(
+            parser,
+            [b"POST / HTTP/1.1\r\nContent-Length: 3\r\nContent-Length: 3\r\n\r\nabc"],
+        )
+        self.assertEqual(messages[0][1:], [b"abc", "end"])
+
+    def test_connect_pauses_parsing(self):
+        parser = HTTPParser(is_response=False)
+        parse(parser, [b"CONNECT example.com:443 HTTP/1.1\r\n\r\n\x16\x03\x01"])
+        self.assertTrue(parser.paused)
+        self.assertEqual(parser.take_paused(), b"\x16\x03\x01")
+
+    def test_file_body_stops_at_message_end(self):
+        parser = HTTPParser(is_response=False)
+        parser.feed(b"PUT /u HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n")
+        rfile = io.BufferedReader(
+            io.BytesIO(b"3\r\nabc\r\n2\r\nde\r\n0\r\n\r\nGET /next HTTP/1.1\r\n\r\n"),
+            buffer_size=4,
+        )
+        body = b"".join(bytes(piece) for piece in iter_file_body(rfile, parser, 2))
+        self.assertEqual(body, b"abcde")
+        self.assertEqual(rfile.read(), b"GET /next HTTP/1.1\r\n\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()